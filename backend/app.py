@@ -5,56 +5,238 @@ Things to change:
 
 # standard library imports
 from datetime import *
-import requests as rq
 import secrets
 import os
 import time
+import base64
+import json
+import click
+import csv
+import io
+import zlib
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 # web routing imports
-from flask import Flask, render_template, request, redirect, url_for, flash, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, jsonify, Response, stream_with_context, make_response, stream_template, get_template_attribute
 from flask_migrate import Migrate
 from flask_cors import CORS
 
 # imports for database
 from sqlalchemy import CheckConstraint
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, make_transient_to_detached
 from flask_sqlalchemy import SQLAlchemy
 
 # client side form library imports
 from wtforms import Form, BooleanField, StringField, validators, IntegerField, SubmitField, PasswordField, ValidationError
 from flask_wtf import FlaskForm
-from flask_login import LoginManager, UserMixin, login_user, current_user, logout_user
+from flask_login import LoginManager, UserMixin, login_user, current_user, logout_user, login_required
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# local imports
+import search
+import importer
+import stats
+from cache import ShelfCache, RedisBackend, LRUCache
+import database
+import metrics
+import enrich
 
 
 # Initializing app, database
 app = Flask(__name__)
 CORS(app)
-app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///bookie.db"
+# DATABASE_URL and DB_PROFILE pick the database and its engine settings
+database.configure(app)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'default_secret_key')
-db = SQLAlchemy(app)
-
-
-migrate = Migrate(app, db)
+app.config['IMPORT_BATCH_SIZE'] = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+app.config['IMPORT_COMMIT_SIZE'] = int(os.getenv('IMPORT_COMMIT_SIZE', 5000))
+app.config['EXPORT_BATCH_SIZE'] = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+app.config['BATCH_MAX_OPERATIONS'] = int(os.getenv('BATCH_MAX_OPERATIONS', 1000))
+app.config['SHELF_CACHE_SIZE'] = int(os.getenv('SHELF_CACHE_SIZE', 256))
+app.config['SHELF_CACHE_REDIS_URL'] = os.getenv('SHELF_CACHE_REDIS_URL')
+# without SHELF_CACHE_REDIS_URL every process keeps its own shelf versions and a
+# write made by another worker or a CLI command shows up only once they expire,
+# so the default is kept short; raise it for a single process
+app.config['SHELF_CACHE_TTL'] = int(os.getenv('SHELF_CACHE_TTL', 300 if app.config['SHELF_CACHE_REDIS_URL'] else 5))
+# larger shelves are streamed from the database on every miss instead of cached whole
+app.config['SHELF_CACHE_MAX_BOOKS'] = int(os.getenv('SHELF_CACHE_MAX_BOOKS', 1000))
+app.config['BOOK_FRAGMENT_CACHE_SIZE'] = int(os.getenv('BOOK_FRAGMENT_CACHE_SIZE', 10000))
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 60))
+# werkzeug hash spec, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000;
+# see benchmarks/bench_password_hash.py for the cost of each setting
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['RECOMMENDATION_TOP_K'] = int(os.getenv('RECOMMENDATION_TOP_K', 50))
+app.config['RECOMMENDATION_STATE_PATH'] = os.getenv('RECOMMENDATION_STATE_PATH', os.path.join(app.instance_path, 'recommendations.npz'))
+# metadata endpoint for filling in genre, isbn and cover_url; unset turns enrichment off
+app.config['METADATA_URL'] = os.getenv('METADATA_URL')
+app.config['ENRICH_WORKERS'] = int(os.getenv('ENRICH_WORKERS', 4))
+# requests per second to the metadata host, 0 for no limit
+app.config['ENRICH_RATE'] = float(os.getenv('ENRICH_RATE', 5))
+app.config['ENRICH_TIMEOUT'] = float(os.getenv('ENRICH_TIMEOUT', 5))
+app.config['ENRICH_MAX_PENDING'] = int(os.getenv('ENRICH_MAX_PENDING', 1000))
+app.config['ENRICH_CACHE_PATH'] = os.getenv('ENRICH_CACHE_PATH', os.path.join(app.instance_path, 'metadata_cache.db'))
+# log requests slower than this many milliseconds along with their SQL
+app.config['SLOW_REQUEST_MS'] = float(os.getenv('SLOW_REQUEST_MS')) if os.getenv('SLOW_REQUEST_MS') else None
+db = SQLAlchemy(app, session_options={'class_': database.RoutingSession})
+database.install_pragmas(app, db)
+database.install_explicit_begin(app, db)
+metrics.init_app(app)
+
+# Per-user shelf cache, shared between workers when a redis url is configured
+shelf_cache = ShelfCache(
+    maxsize=app.config['SHELF_CACHE_SIZE'],
+    ttl=app.config['SHELF_CACHE_TTL'],
+    shared=RedisBackend.from_url(app.config['SHELF_CACHE_REDIS_URL']) if app.config['SHELF_CACHE_REDIS_URL'] else None,
+)
+
+
+# Keep autogenerate away from tables that only exist through raw DDL in migrations
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ == 'table' and name.startswith(search.FTS_TABLE))
+
+migrate = Migrate(app, db, include_object=include_object)
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-# iterator list
-numbers = list(range(0,30))
+# Rendered book cells, keyed by (book id, change_id)
+fragment_cache = LRUCache(maxsize=app.config['BOOK_FRAGMENT_CACHE_SIZE'])
+
+# Logged in users, so load_user doesn't hit the database on every request
+user_cache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+# Password hashing is deliberately slow; it runs on a bounded pool so a burst
+# of logins queues up instead of taking every core from the other requests
+password_pool = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'],
+                                   thread_name_prefix='password-hash')
+
+def hash_password(password):
+    return password_pool.submit(
+        generate_password_hash, password, method=app.config['PASSWORD_HASH_METHOD']).result()
+
+def verify_password(stored, password):
+    return password_pool.submit(check_password_hash, stored, password).result()
+
+# Runs on an enrichment worker once a book's metadata has been found
+def save_metadata(book_id, title, author, metadata):
+    with app.app_context():
+        with db.engine.begin() as conn:
+            owner_id = enrich.apply_metadata(conn, book_id, title, author, metadata)
+    if owner_id is not None:
+        shelf_cache.invalidate(owner_id)
+
+def create_enricher():
+    cache_path = app.config['ENRICH_CACHE_PATH']
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    client = enrich.MetadataClient(app.config['METADATA_URL'], rate=app.config['ENRICH_RATE'],
+                                   timeout=app.config['ENRICH_TIMEOUT'], pool_size=app.config['ENRICH_WORKERS'])
+    return enrich.Enricher(client, enrich.MetadataCache(cache_path), save_metadata,
+                           workers=app.config['ENRICH_WORKERS'], max_pending=app.config['ENRICH_MAX_PENDING'])
+
+# Metadata lookups never run on the request thread, adding a book only queues one
+enricher = create_enricher() if app.config['METADATA_URL'] else None
+
+def log_enrich_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        app.logger.warning('Metadata lookup failed: %s', future.exception())
+
+def enrich_book(book_id, title, author):
+    if enricher is None:
+        return
+    future = enricher.submit(book_id, title, author)
+    if future is not None:
+        future.add_done_callback(log_enrich_error)
+
+# Imports and batches can add thousands of books, they are queued from a
+# background thread rather than dropped when the queue is full
+def enrich_books_later(books):
+    if enricher is not None and books:
+        enricher.submit_many(books, log_enrich_error)
+
+# Rows of a select on book, read a page at a time in id order so a large
+# shelf never sits in memory. Each page is read in its own short transaction:
+# the enrich workers' updates can't commit while a read holds the database lock.
+def page_books(query, after_id=0):
+    while True:
+        with app.app_context():
+            rows = db.session.execute(
+                query.where(Book.id > after_id).order_by(Book.id).limit(app.config['EXPORT_BATCH_SIZE'])).all()
+        if not rows:
+            return
+        yield from rows
+        after_id = rows[-1][0]
+
+# werkzeug fills in defaults for short specs ('scrypt' is stored as
+# scrypt:32768:8:1), so the full spec is read back from a hash made with it
+@functools.lru_cache(maxsize=None)
+def expand_hash_method(method):
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+# Hashed with a spec that no longer matches PASSWORD_HASH_METHOD
+def needs_rehash(stored):
+    return not stored.startswith(expand_hash_method(app.config['PASSWORD_HASH_METHOD']) + '$')
+
+# Accounts created before passwords were hashed store them as plain text
+def is_password_hash(stored):
+    return stored.startswith(('scrypt:', 'pbkdf2:')) and stored.count('$') == 2
+
+# A few early accounts hold bcrypt hashes, some stored as bytes
+def stored_password(stored):
+    return stored.decode('utf-8', 'replace') if isinstance(stored, bytes) else stored
+
+def is_bcrypt_hash(stored):
+    return stored.startswith(('$2a$', '$2b$', '$2y$'))
+
+# bcrypt is optional; without it those accounts can't log in until reset
+def verify_bcrypt(stored, password):
+    try:
+        import bcrypt
+    except ImportError:
+        return False
+    return password_pool.submit(bcrypt.checkpw, password.encode(), stored.encode()).result()
+
+# page sizes for the json listing and search
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# allowed ratings, enforced by the rating_range constraint
+MIN_RATING = 1
+MAX_RATING = 5
 
 # Database classes
 class User(db.Model, UserMixin):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
-    user_name = db.Column(db.String(20), nullable=False)
-    password = db.Column(db.String(30), nullable=False)
+    user_name = db.Column(db.String(20), nullable=False, unique=True, index=True)
+    password = db.Column(db.String(255), nullable=False)
     bookshelf = db.relationship('Book', backref='User', lazy='dynamic')
 
     @staticmethod
     def authenticate(username, password):
         user = User.query.filter_by(user_name=username).first()
-        if user and user.password == password:
-            return user
-        return None
+        if user is None:
+            # hash anyway so response times don't reveal which usernames exist
+            hash_password(password)
+            return None
+
+        stored = stored_password(user.password)
+        if is_password_hash(stored):
+            valid = verify_password(stored, password)
+        elif is_bcrypt_hash(stored):
+            valid = verify_bcrypt(stored, password)
+        else:
+            valid = secrets.compare_digest(stored.encode(), password.encode())
+        if not valid:
+            return None
+
+        if needs_rehash(stored):
+            user.password = hash_password(password)
+            db.session.commit()
+            user_cache.delete(user.id)
+        return user
 
     def __repr__(self):
         return '<Username: %s>' % self.id
@@ -67,14 +249,160 @@ class Book(db.Model):
     date_created = db.Column(db.DateTime, default= lambda : datetime.now(timezone.utc))
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     rating = db.Column(db.Double, nullable=False)
+    # filled in by the enrichment workers
+    isbn = db.Column(db.String(20))
+    cover_url = db.Column(db.String(500))
+    # position in the write order of all books, set by triggers on insert and
+    # every edit; /api/export?since= reads the changes after a position, and
+    # it keys the cached book cell
+    change_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     __table_args__ = (
-        db.CheckConstraint('rating BETWEEN 1 AND 5', name='rating_range'),
+        db.CheckConstraint('rating BETWEEN %d AND %d' % (MIN_RATING, MAX_RATING), name='rating_range'),
+        # keyset pagination of a user's shelf; sqlite appends the rowid (id)
+        # to every index entry, so this also covers the (date_created, id) order
+        db.Index('ix_book_owner_id_date_created', 'owner_id', 'date_created'),
+        db.Index('ix_book_owner_id_change_id', 'owner_id', 'change_id'),
     )
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'author': self.author,
+            'genre': self.genre,
+            'rating': self.rating,
+            'date_created': self.date_created.isoformat() if self.date_created else None,
+            'isbn': self.isbn,
+            'cover_url': self.cover_url,
+        }
+
+    @staticmethod
+    def validate_text(record, name, required=False):
+        value = str(record.get(name) or '').strip()
+        if required and not value:
+            raise ValueError('%s is required' % name)
+        length = Book.__table__.c[name].type.length
+        if len(value) > length:
+            raise ValueError('%s is longer than %d characters' % (name, length))
+        return value
+
+    @staticmethod
+    def validate_rating(value):
+        # Mirrors the rating_range constraint
+        try:
+            rating = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('rating must be a number')
+        if not MIN_RATING <= rating <= MAX_RATING:
+            raise ValueError('rating must be between %d and %d' % (MIN_RATING, MAX_RATING))
+        return rating
+
+    @staticmethod
+    def validate_row(record, owner_id):
+        # Checks a new book (imported or batched) against the column sizes and rating_range
+        created = record.get('date_created')
+        if created:
+            try:
+                # Goodreads exports dates as YYYY/MM/DD
+                created = datetime.fromisoformat(str(created).strip().replace('/', '-'))
+            except ValueError:
+                raise ValueError('date_created is not a valid date')
+        else:
+            created = datetime.now(timezone.utc)
+
+        return {
+            'title': Book.validate_text(record, 'title', required=True),
+            'author': Book.validate_text(record, 'author'),
+            'genre': Book.validate_text(record, 'genre'),
+            'rating': Book.validate_rating(record.get('rating')),
+            'date_created': created,
+            'owner_id': owner_id,
+        }
+
+    @staticmethod
+    def validate_changes(record):
+        # Checks the editable fields present in an update
+        changes = {}
+        for name in ('title', 'author', 'genre'):
+            if name in record:
+                changes[name] = Book.validate_text(record, name, required=(name == 'title'))
+        if 'rating' in record:
+            changes['rating'] = Book.validate_rating(record['rating'])
+        if not changes:
+            raise ValueError('nothing to update')
+        return changes
+
     def __repr__(self):
         return '<Book %r>' % self.id
 
+# Reading statistics, maintained by triggers on book (see stats.py)
+class ShelfRatingStat(db.Model):
+    __tablename__ = 'shelf_rating_stats'
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    rating = db.Column(db.Integer, primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False)
+
+class ShelfGenreStat(db.Model):
+    __tablename__ = 'shelf_genre_stats'
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    genre = db.Column(db.String(100), primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False)
+    rating_sum = db.Column(db.Double, nullable=False)
+
+class ShelfMonthStat(db.Model):
+    __tablename__ = 'shelf_month_stats'
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False)
+
+class ShelfAuthorStat(db.Model):
+    __tablename__ = 'shelf_author_stats'
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    author = db.Column(db.String(100), primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_shelf_author_stats_owner_id_book_count', 'owner_id', 'book_count'),
+    )
+
+# Recommendation tables, written by recommend.train() / recommend.update()
+class RecItem(db.Model):
+    __tablename__ = 'rec_item'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    item_key = db.Column(db.String(205), nullable=False, unique=True, index=True)
+    title = db.Column(db.String(100), nullable=False)
+    author = db.Column(db.String(100), nullable=False)
+
+class RecNeighbor(db.Model):
+    __tablename__ = 'rec_neighbor'
+    item_id = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.Integer, primary_key=True)
+    score = db.Column(db.Double, nullable=False)
+
+# Owners whose shelves changed since the last refresh, marked by triggers on book
+class RecDirtyOwner(db.Model):
+    __tablename__ = 'rec_dirty_owner'
+    owner_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    generation = db.Column(db.Integer, nullable=False)
+
+# The last change_id handed out, bumped by the book_change triggers
+class BookChangeCounter(db.Model):
+    __tablename__ = 'book_change_counter'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    value = db.Column(db.Integer, nullable=False)
+
+# Books deleted, and when in the write order, so deltas can report them
+class DeletedBook(db.Model):
+    __tablename__ = 'deleted_book'
+    book_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    change_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    owner_id = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_deleted_book_owner_id_change_id', 'owner_id', 'change_id'),
+    )
+
 # Flask-Login Classes
 class RegistrationForm(FlaskForm):
     # Enter username, password.
@@ -91,7 +419,19 @@ class LoginForm(FlaskForm):
 # Flask Login Methods
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        # attach a copy to this request's session without querying;
+        # columns that aren't cached load lazily if anything needs them
+        user = User(**cached)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = db.session.get(User, user_id)
+    if user is not None:
+        user_cache.set(user_id, {'id': user.id, 'user_name': user.user_name})
+    return user
 
 def url_has_allowed_host_and_scheme(url, host):
     if not url:
@@ -131,7 +471,7 @@ def register():
             return render_template('register.html', form=form)
         else:
             try:
-                user = User(user_name=username, password=password)
+                user = User(user_name=username, password=hash_password(password))
                 db.session.add(user)
                 db.session.commit()
                 flash('Registration successful!', 'success')
@@ -149,6 +489,8 @@ def home():
 
 @app.route("/logout")
 def logout():
+    if current_user.is_authenticated:
+        user_cache.delete(current_user.id)
     logout_user()
     return redirect("/")
 
@@ -161,31 +503,368 @@ def index():
         book_genre = request.form.get('genre')
         book_rating = request.form.get('rating')
         owner_id= current_user.id
-        username = User.query.filter_by(id=owner_id).first().user_name
         new_book = Book(title=book_title, author=book_author, genre=book_genre, rating=book_rating, owner_id=owner_id)
         try:
             db.session.add(new_book)
+            db.session.flush()
+            book_id = new_book.id
             db.session.commit()
-            # Query the database
-            Books = Book.query.order_by(Book.date_created).all()
+            shelf_cache.invalidate(owner_id)
+            enrich_book(book_id, book_title, book_author)
             return redirect(url_for('index'))
         except Exception as e:
             return f'{str(e)}'
     else:
         owner_id= current_user.id
-        username = User.query.filter_by(id=owner_id).first().user_name
-        Books = Book.query.order_by(Book.date_created).all()
-        return render_template('index.html',   packed=zip(Books, numbers), username=username)
+        version = shelf_cache.version(owner_id)
+        etag = shelf_cache.etag(owner_id, version)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+
+        books = iter_shelf(owner_id, version)
+        response = Response(stream_template('index.html', books=books, username=current_user.user_name))
+        return with_etag(response, etag)
+
+# Yields the owner's books from the shelf cache, or streams them from the
+# database and caches the shelf once it has been read if it is small enough
+def iter_shelf(owner_id, version):
+    cached = shelf_cache.get(owner_id, version)
+    if cached is not None:
+        yield from cached
+        return
+
+    columns = [Book.id, Book.title, Book.author, Book.genre, Book.rating, Book.date_created, Book.change_id]
+    query = db.select(*columns).where(Book.owner_id == owner_id).order_by(Book.date_created, Book.id)
+    result = db.session.execute(query.execution_options(yield_per=app.config['EXPORT_BATCH_SIZE'])).mappings()
+
+    books = []
+    for row in result:
+        book = dict(row)
+        if books is not None:
+            books.append(book)
+            if len(books) > app.config['SHELF_CACHE_MAX_BOOKS']:
+                books = None
+        yield book
+    if books is not None:
+        shelf_cache.set(owner_id, version, books)
+
+# Book cells only change when the book is written, so each is rendered once.
+# change_id is unique across all books, unlike a per-book version, so a book
+# that reuses a deleted book's id can never be served the old cell
+@app.template_global()
+def book_cell(book):
+    key = (book['id'], book['change_id'])
+    cell = fragment_cache.get(key)
+    if cell is None:
+        cell = get_template_attribute('_book_cell.html', 'book_cell')(book)
+        fragment_cache.set(key, cell)
+    return cell
+
+# Shelf responses are revalidated on every use, a matching ETag costs no queries
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def not_modified(etag):
+    return with_etag(make_response('', 304), etag)
+
+# Cursors are opaque to clients: the (date_created, id) of the last book on a page
+def encode_cursor(book):
+    raw = json.dumps([book.date_created.isoformat(), book.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        created, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created), int(book_id)
+    except (ValueError, TypeError):
+        abort(400, description='Invalid cursor')
+
+# JSON bookshelf listing, keyset paginated on (date_created, id)
+@app.route('/api/books')
+@login_required
+def list_books():
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    version = shelf_cache.version(current_user.id)
+    etag = shelf_cache.etag(current_user.id, version)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    query = Book.query.filter(Book.owner_id == current_user.id)
+
+    genre = request.args.get('genre')
+    if genre:
+        query = query.filter(Book.genre == genre)
+    min_rating = request.args.get('min_rating', type=float)
+    if min_rating is not None:
+        query = query.filter(Book.rating >= min_rating)
+    max_rating = request.args.get('max_rating', type=float)
+    if max_rating is not None:
+        query = query.filter(Book.rating <= max_rating)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        created, book_id = decode_cursor(cursor)
+        query = query.filter(db.tuple_(Book.date_created, Book.id) > db.tuple_(created, book_id))
+
+    # fetch one extra row to know whether there is a next page
+    books = query.order_by(Book.date_created, Book.id).limit(limit + 1).all()
+    next_cursor = encode_cursor(books[limit - 1]) if len(books) > limit else None
+
+    response = jsonify(books=[book.to_dict() for book in books[:limit]], next_cursor=next_cursor)
+    return with_etag(response, etag)
+
+# Full-text search over the current user's shelf, best matches first
+@app.route('/api/search')
+@login_required
+def search_books():
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    match = search.build_match_query(request.args.get('q'), current_user.id)
+    if match is None:
+        return jsonify(books=[])
+
+    books = Book.query.from_statement(search.SEARCH_SQL).params(match=match, limit=limit).all()
+    return jsonify(books=[book.to_dict() for book in books])
+
+def import_books_from(stream, fmt, owner_id):
+    records = importer.iter_records(stream, fmt)
+    return importer.import_records(
+        db.session, db.insert(Book), records,
+        validate=lambda record: Book.validate_row(record, owner_id),
+        batch_size=app.config['IMPORT_BATCH_SIZE'],
+        commit_size=app.config['IMPORT_COMMIT_SIZE'],
+        connection_options={database.EXPLICIT_BEGIN: True},
+    )
+
+# Bulk import of an uploaded CSV or JSONL shelf
+@app.route('/api/import', methods=['POST'])
+@login_required
+def import_books():
+    upload = request.files.get('file')
+    if upload is None:
+        abort(400, description='No file uploaded')
+
+    fmt = request.form.get('format') or importer.detect_format(upload.filename)
+    if fmt not in importer.FORMATS:
+        abort(400, description='Format must be one of: %s' % ', '.join(importer.FORMATS))
+
+    owner_id = current_user.id
+    # imported rows get ids above the current maximum
+    last_id = db.session.execute(db.select(db.func.max(Book.id))).scalar() or 0
+    report = import_books_from(upload.stream, fmt, owner_id)
+    shelf_cache.invalidate(owner_id)
+    if enricher is not None and report.imported:
+        enrich_books_later(page_books(
+            db.select(Book.id, Book.title, Book.author).where(Book.owner_id == owner_id), last_id))
+    return jsonify(report.to_dict())
+
+EXPORT_FIELDS = ('id', 'title', 'author', 'genre', 'rating', 'date_created')
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def encode_export_rows(rows, fmt):
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(row)
+        return buffer.getvalue().encode()
+    return ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n' for row in rows).encode()
+
+def encode_deleted_rows(book_ids, fmt):
+    if fmt == 'csv':
+        blanks = ('',) * (len(EXPORT_FIELDS) - 1)
+        return encode_export_rows([(book_id,) + blanks + ('true',) for book_id in book_ids], fmt)
+    return ''.join(json.dumps({'id': book_id, 'deleted': True}) + '\n' for book_id in book_ids).encode()
+
+# Streams the current user's shelf, one database batch per chunk.
+# The X-Export-Cursor header marks where in the write order the export was
+# taken; since=<cursor> then exports only the books added, edited or
+# deleted after it (deletions first, as {"id": ..., "deleted": true}).
+@app.route('/api/export')
+@login_required
+def export_books():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_MIMETYPES:
+        abort(400, description='Format must be csv or ndjson')
+
+    owner_id = current_user.id
+    since = request.args.get('since')
+    if since is not None and not since.isdigit():
+        abort(400, description='since must be a cursor from X-Export-Cursor')
+    # read before the rows, so changes made during the export are sent again
+    # in the next delta rather than skipped
+    cursor = db.session.execute(db.select(BookChangeCounter.value)).scalar() or 0
+
+    columns = [getattr(Book, field) for field in EXPORT_FIELDS]
+    query = db.select(*columns).where(Book.owner_id == owner_id)
+    if since is None:
+        query = query.order_by(Book.date_created, Book.id)
+    else:
+        query = query.where(Book.change_id > int(since)).order_by(Book.change_id)
+        deleted = db.select(DeletedBook.book_id).where(
+            DeletedBook.owner_id == owner_id, DeletedBook.change_id > int(since)).order_by(DeletedBook.change_id)
+
+    gzip = request.accept_encodings['gzip'] > 0
+
+    def generate():
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if gzip else None
+
+        def emit(data):
+            if compressor is None:
+                return data
+            # sync flush so every chunk reaches the client as soon as it is read
+            return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        if fmt == 'csv':
+            header = EXPORT_FIELDS if since is None else EXPORT_FIELDS + ('deleted',)
+            yield emit(encode_export_rows([header], fmt))
+
+        # a book id can be reused after a delete, so deletions go first
+        if since is not None:
+            result = db.session.execute(
+                deleted.execution_options(yield_per=app.config['EXPORT_BATCH_SIZE']))
+            for partition in result.scalars().partitions():
+                yield emit(encode_deleted_rows(partition, fmt))
+
+        result = db.session.execute(
+            query.execution_options(yield_per=app.config['EXPORT_BATCH_SIZE']))
+        for partition in result.partitions():
+            rows = [row[:-1] + (row[-1].isoformat() if row[-1] else None,) for row in partition]
+            if fmt == 'csv' and since is not None:
+                rows = [row + ('',) for row in rows]
+            yield emit(encode_export_rows(rows, fmt))
+
+        if compressor is not None:
+            yield compressor.flush()
+
+    response = Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=bookshelf.%s' % fmt
+    response.headers['X-Export-Cursor'] = str(cursor)
+    response.vary.add('Accept-Encoding')
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# Reading statistics from the summary tables, no scan of book
+@app.route('/api/stats')
+@login_required
+def reading_stats():
+    version = shelf_cache.version(current_user.id)
+    etag = shelf_cache.etag(current_user.id, version)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    response = jsonify(stats.user_stats(db.session.connection(), current_user.id))
+    return with_etag(response, etag)
+
+# Creates, updates and deletes many books in one transaction.
+# Invalid operations are reported and skipped, the rest are applied together.
+@app.route('/api/books/batch', methods=['POST'])
+@login_required
+def batch_books():
+    payload = request.get_json(silent=True)
+    operations = payload.get('operations') if isinstance(payload, dict) else None
+    if not isinstance(operations, list):
+        abort(400, description='Expected a JSON body with an operations list')
+    if len(operations) > app.config['BATCH_MAX_OPERATIONS']:
+        abort(413, description='At most %d operations per batch' % app.config['BATCH_MAX_OPERATIONS'])
+
+    owner_id = current_user.id
+    results = [None] * len(operations)
+    creates, updates, deletes = [], {}, {}
+
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        try:
+            if op == 'create':
+                creates.append((index, Book.validate_row(operation, owner_id)))
+            elif op in ('update', 'delete'):
+                try:
+                    book_id = int(operation.get('id'))
+                except (TypeError, ValueError):
+                    raise ValueError('id must be an integer')
+                if op == 'update':
+                    updates[index] = (book_id, Book.validate_changes(operation))
+                else:
+                    deletes[index] = book_id
+            else:
+                raise ValueError('op must be create, update or delete')
+        except ValueError as e:
+            results[index] = {'index': index, 'op': op, 'status': 'error', 'error': str(e)}
+
+    # one ownership check for every targeted book
+    targets = {book_id for book_id, _ in updates.values()} | set(deletes.values())
+    owned = set()
+    if targets:
+        owned = set(db.session.execute(
+            db.select(Book.id).where(Book.owner_id == owner_id, Book.id.in_(targets))).scalars())
+    for operations_by_index, op in ((updates, 'update'), (deletes, 'delete')):
+        for index in list(operations_by_index):
+            entry = operations_by_index[index]
+            book_id = entry[0] if op == 'update' else entry
+            if book_id not in owned:
+                del operations_by_index[index]
+                results[index] = {'index': index, 'op': op, 'id': book_id, 'status': 'error', 'error': 'book not found'}
+
+    try:
+        if creates:
+            created_ids = db.session.execute(
+                db.insert(Book).returning(Book.id, sort_by_parameter_order=True),
+                [values for _, values in creates]).scalars().all()
+            for (index, _), book_id in zip(creates, created_ids):
+                results[index] = {'index': index, 'op': 'create', 'id': book_id, 'status': 'created'}
+        if updates:
+            # bulk UPDATE by primary key, executemany per distinct set of columns
+            db.session.execute(db.update(Book), [
+                dict(changes, id=book_id) for book_id, changes in updates.values()])
+            for index, (book_id, _) in updates.items():
+                results[index] = {'index': index, 'op': 'update', 'id': book_id, 'status': 'updated'}
+        if deletes:
+            db.session.execute(
+                db.delete(Book).where(Book.owner_id == owner_id, Book.id.in_(set(deletes.values()))),
+                execution_options={'synchronize_session': False})
+            for index, book_id in deletes.items():
+                results[index] = {'index': index, 'op': 'delete', 'id': book_id, 'status': 'deleted'}
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify(error='Batch rolled back: %s' % e), 409
+
+    if creates or updates or deletes:
+        shelf_cache.invalidate(owner_id)
+    if creates:
+        enrich_books_later([(book_id, values['title'], values['author'])
+                            for (_, values), book_id in zip(creates, created_ids)])
+    return jsonify(results=results)
+
+# "Readers like you" recommendations from the precomputed neighbour table
+@app.route('/api/recommendations')
+@login_required
+def recommendations():
+    limit = request.args.get('limit', 10, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # imported here so only recommendations need numpy and scipy
+    import recommend
+    books = recommend.recommendations(db.session.connection(), current_user.id, limit=limit)
+    return jsonify(recommendations=books)
 
 @app.route('/delete/<int:id>', methods=['GET', 'POST'])
 def delete(id):
     if request.method == 'POST':
         # Grab id for book
         target_book = db.get_or_404(Book, id)
+        owner_id = target_book.owner_id
 
         try:
             db.session.delete(target_book)
             db.session.commit()
+            shelf_cache.invalidate(owner_id)
         except Exception as e:
             return f'{str(e)}'
         return redirect(url_for('index'))
@@ -196,6 +875,7 @@ def delete(id):
 def update(id):
     
     book = db.get_or_404(Book, id)
+    owner_id = book.owner_id
     if request.method == 'POST':
         book.rating = request.form.get('rating')
     else:
@@ -203,9 +883,99 @@ def update(id):
 
     try:     
         db.session.commit()
+        shelf_cache.invalidate(owner_id)
         return redirect('/')
     except Exception as e:
         return f'{str(e)}'
 
+# CLI commands
+@app.cli.command('rebuild-search')
+@click.option('--batch-size', default=500, show_default=True, help='Books indexed per transaction.')
+@click.option('--optimize', is_flag=True, help='Merge the index b-trees once the backfill is done.')
+def rebuild_search(batch_size, optimize):
+    """Backfill the book_fts search index from the book table."""
+    indexed = search.rebuild_index(db.engine, batch_size=batch_size, optimize=optimize)
+    click.echo(f'Indexed {indexed} books.')
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='Owner of the imported books.')
+@click.option('--format', 'fmt', type=click.Choice(importer.FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', type=int, help='Rows per executemany batch.')
+@click.option('--commit-size', type=int, help='Rows per commit.')
+def import_books_command(path, username, fmt, batch_size, commit_size):
+    """Import a CSV or JSONL bookshelf for a user."""
+    user = User.query.filter_by(user_name=username).first()
+    if user is None:
+        raise click.ClickException(f'No such user: {username}')
+    fmt = fmt or importer.detect_format(path)
+    if fmt is None:
+        raise click.ClickException('Cannot tell the format from the file name, pass --format.')
+    if batch_size:
+        app.config['IMPORT_BATCH_SIZE'] = batch_size
+    if commit_size:
+        app.config['IMPORT_COMMIT_SIZE'] = commit_size
+
+    with open(path, 'rb') as stream:
+        report = import_books_from(stream, fmt, user.id)
+    shelf_cache.invalidate(user.id)
+
+    click.echo(f'Imported {report.imported} books, {report.failed} failed.')
+    for error in report.errors:
+        click.echo(f"  line {error['line']}: {error['error']}", err=True)
+
+@app.cli.command('reconcile-stats')
+@click.option('--fix', is_flag=True, help='Rebuild the tables that drifted.')
+def reconcile_stats(fix):
+    """Recompute the reading statistics from scratch and report drift."""
+    drift = stats.reconcile(db.engine, fix=fix)
+    for table, key, expected, actual in drift:
+        click.echo(f'{table} {key}: expected {expected}, found {actual}')
+    if not drift:
+        click.echo('Statistics are in sync.')
+    elif fix:
+        click.echo(f'Fixed {len(drift)} drifted rows.')
+    else:
+        raise click.ClickException(f'{len(drift)} drifted rows, run with --fix to rebuild.')
+
+@app.cli.command('refresh-recommendations')
+@click.option('--full', is_flag=True, help='Retrain from scratch instead of updating changed shelves.')
+def refresh_recommendations(full):
+    """Update the recommendation neighbour table."""
+    import recommend
+    start = time.perf_counter()
+    state_path = app.config['RECOMMENDATION_STATE_PATH']
+    k = app.config['RECOMMENDATION_TOP_K']
+    if full:
+        count, retrained = recommend.train(db.engine, state_path, k), True
+    else:
+        count, retrained = recommend.update(db.engine, state_path, k)
+    if retrained:
+        click.echo(f'Trained on {count} books in {time.perf_counter() - start:.2f}s.')
+    else:
+        click.echo(f'Updated {count} neighbour lists in {time.perf_counter() - start:.2f}s.')
+
+@app.cli.command('enrich-books')
+@click.option('--limit', type=int, help='Look up at most this many books.')
+def enrich_books(limit):
+    """Fill in missing genre, isbn and cover_url from METADATA_URL."""
+    if enricher is None:
+        raise click.ClickException('Set METADATA_URL to enrich books.')
+    start = time.perf_counter()
+    missing = db.or_(Book.genre.is_(None), Book.genre == '', Book.isbn.is_(None), Book.cover_url.is_(None))
+    books = page_books(db.select(Book.id, Book.title, Book.author).where(missing))
+    if limit is not None:
+        books = itertools.islice(books, limit)
+    # block on a full queue here, there is no request waiting on us
+    futures = [enricher.submit(book_id, title, author, block=True) for book_id, title, author in books]
+    found = failed = 0
+    for future in futures:
+        if future.exception() is not None:
+            failed += 1
+        elif future.result():
+            found += 1
+    click.echo(f'Found metadata for {found} of {len(futures)} books ({enricher.requests} requests, '
+               f'{failed} failed) in {time.perf_counter() - start:.2f}s.')
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
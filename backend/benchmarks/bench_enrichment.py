@@ -0,0 +1,135 @@
+"""
+Throughput of the metadata enrichment pipeline, cold and warm cache.
+
+Starts a local stub metadata server that answers after --latency ms (and
+404s one title in ten), then pushes --books lookups drawn from a catalog of
+--distinct titles (popularity is skewed, like real shelves) through an
+Enricher with --workers threads. The same books are run twice against one
+on-disk cache: cold, where every distinct title costs a request, and warm,
+where none should.
+
+    python benchmarks/bench_enrichment.py --books 2000 --distinct 500 --latency 20
+    python benchmarks/bench_enrichment.py --workers 16 --rate 50
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from bench_routes import BACKEND_DIR, summarize
+
+sys.path.insert(0, BACKEND_DIR)
+import enrich
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, so the client's pooled connections get reused
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.hits += 1
+        time.sleep(self.server.latency)
+        params = parse_qs(urlsplit(self.path).query)
+        title = params.get('title', [''])[0]
+        digest = zlib.crc32(title.encode())
+        if digest % 10 == 0:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({
+            'genre': 'Genre %d' % (digest % 20),
+            'isbn': '978%010d' % (digest % 10 ** 10),
+            'cover_url': 'https://covers.example/%d.jpg' % digest,
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(latency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.hits = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(enricher, books):
+    latencies = []
+    lock = threading.Lock()
+
+    def done(started):
+        def record(future):
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        return record
+
+    requests_before = enricher.requests
+    start = time.perf_counter()
+    futures = []
+    for book_id, title, author in books:
+        future = enricher.submit(book_id, title, author, block=True)
+        future.add_done_callback(done(time.perf_counter()))
+        futures.append(future)
+    found = sum(1 for future in futures if future.result())
+    result = summarize(latencies, 0, time.perf_counter() - start)
+    result['found'] = found
+    result['requests'] = enricher.requests - requests_before
+    return result
+
+
+def report(name, result):
+    print('%-5s %8.1f books/sec, p50 %7.2f ms, p95 %7.2f ms, p99 %7.2f ms, %5d requests, %5d found' % (
+        name, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+        result['requests'], result['found']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=2000, help='lookups per run')
+    parser.add_argument('--distinct', type=int, default=500, help='catalog size')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=0, help='requests/sec to the stub, 0 for no limit')
+    parser.add_argument('--latency', type=float, default=20, help='stub response time in ms')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    weights = [1.0 / (rank + 1) for rank in range(args.distinct)]
+    books = [(n, 'Title %d' % item, 'Author %d' % (item % 101))
+             for n, item in enumerate(rng.choices(range(args.distinct), weights=weights, k=args.books))]
+    print('%d books, %d distinct titles' % (len(books), len({title for _, title, _ in books})))
+
+    server = start_stub(args.latency / 1000)
+    url = 'http://127.0.0.1:%d/metadata' % server.server_port
+    with tempfile.TemporaryDirectory() as directory:
+        client = enrich.MetadataClient(url, rate=args.rate, pool_size=args.workers)
+        cache = enrich.MetadataCache(os.path.join(directory, 'metadata_cache.db'))
+        enricher = enrich.Enricher(client, cache, lambda book_id, title, author, metadata: None,
+                                   workers=args.workers, max_pending=4 * args.workers)
+        try:
+            report('cold', run(enricher, books))
+            report('warm', run(enricher, books))
+        finally:
+            enricher.shutdown()
+    print('stub served %d requests' % server.hits)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
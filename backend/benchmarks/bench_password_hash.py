@@ -0,0 +1,64 @@
+"""
+Measures what a PASSWORD_HASH_METHOD setting costs at login.
+
+For every hash spec it reports the time of a single verification and the
+verifications per second a pool of --workers threads sustains, which is the
+ceiling on logins per second for one app process using that setting.
+
+    python benchmarks/bench_password_hash.py
+    python benchmarks/bench_password_hash.py --workers 8 scrypt:16384:8:1 pbkdf2:sha256:600000
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+DEFAULT_METHODS = (
+    'scrypt:16384:8:1',
+    'scrypt:32768:8:1',
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha256:600000',
+)
+
+
+def bench_method(method, rounds, workers):
+    stored = generate_password_hash('correct horse battery', method=method)
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        check_password_hash(stored, 'correct horse battery')
+        timings.append(time.perf_counter() - start)
+
+    total = rounds * workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda _: check_password_hash(stored, 'correct horse battery'), range(total)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'method': method,
+        'verify_ms': statistics.median(timings) * 1000,
+        'verifies_per_sec': total / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('methods', nargs='*', default=DEFAULT_METHODS, help='werkzeug hash specs to compare')
+    parser.add_argument('--rounds', type=int, default=10, help='verifications per method and worker')
+    parser.add_argument('--workers', type=int, default=4, help='size of the verification pool')
+    args = parser.parse_args()
+
+    print('%-24s %12s %16s' % ('method', 'verify (ms)', 'verifies/sec'))
+    for method in args.methods:
+        result = bench_method(method, args.rounds, args.workers)
+        print('%-24s %12.1f %16.1f' % (result['method'], result['verify_ms'], result['verifies_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Training and serving cost of the recommendation engine.
+
+Seeds a throwaway database with --users shelves drawn from a catalog of
+--items books (popularity is skewed, like real shelves), then times a full
+train, an incremental update after --dirty users change their shelves, and
+the latency of serving recommendations.
+
+    python benchmarks/bench_recommendations.py --users 2000 --items 20000 --shelf 80
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from bench_routes import load_app, summarize
+
+
+def seed(bookie, users, items, shelf, rng):
+    app, db, User, Book = bookie.app, bookie.db, bookie.User, bookie.Book
+    weights = [1.0 / (rank + 1) for rank in range(items)]
+    now = datetime.now(timezone.utc)
+    with app.app_context():
+        db.session.execute(db.insert(User), [
+            {'user_name': 'rec_user_%d' % n, 'password': '-'} for n in range(users)])
+        owner_ids = list(db.session.execute(db.select(User.id)).scalars())
+        for owner_id in owner_ids:
+            picks = set(rng.choices(range(items), weights=weights, k=rng.randint(1, 2 * shelf)))
+            db.session.execute(db.insert(Book), [{
+                'title': 'Title %d' % item, 'author': 'Author %d' % (item % 1009), 'genre': '',
+                'rating': rng.randint(1, 5), 'date_created': now, 'owner_id': owner_id,
+            } for item in picks])
+        db.session.commit()
+    return owner_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=5000, help='catalog size')
+    parser.add_argument('--shelf', type=int, default=40, help='average books per user')
+    parser.add_argument('--k', type=int, default=50, help='neighbours kept per book')
+    parser.add_argument('--dirty', type=int, default=10, help='users changed before the incremental update')
+    parser.add_argument('--requests', type=int, default=200, help='recommendation requests to time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bookie = load_app(os.path.join(directory, 'bench.db'))
+        import recommend
+        app, db, Book = bookie.app, bookie.db, bookie.Book
+        state_path = os.path.join(directory, 'recommendations.npz')
+
+        start = time.perf_counter()
+        owner_ids = seed(bookie, args.users, args.items, args.shelf, rng)
+        print('seeded %d users in %.2fs' % (len(owner_ids), time.perf_counter() - start))
+
+        with app.app_context():
+            start = time.perf_counter()
+            items = recommend.train(db.engine, state_path, args.k)
+            print('full train:         %8.2fs  (%d books)' % (time.perf_counter() - start, items))
+
+            # re-rate half of each dirty shelf and add a new book to it
+            for owner_id in rng.sample(owner_ids, min(args.dirty, len(owner_ids))):
+                db.session.execute(db.update(Book).where(Book.owner_id == owner_id, Book.id % 2 == 0)
+                                   .values(rating=6 - Book.rating))
+                db.session.add(Book(title='Title %d' % rng.randrange(args.items), author='New author',
+                                    genre='', rating=rng.randint(1, 5), owner_id=owner_id))
+            db.session.commit()
+
+            start = time.perf_counter()
+            changed, _ = recommend.update(db.engine, state_path, args.k)
+            print('incremental update: %8.2fs  (%d neighbour lists changed)' % (time.perf_counter() - start, changed))
+
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                owner_id = rng.choice(owner_ids)
+                request_start = time.perf_counter()
+                with db.engine.connect() as conn:
+                    recommend.recommendations(conn, owner_id, limit=10)
+                latencies.append(time.perf_counter() - request_start)
+            result = summarize(latencies, 0, time.perf_counter() - started)
+            print('serving:            %8.1f req/sec, p50 %.2f ms, p95 %.2f ms, p99 %.2f ms' % (
+                result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""
+Route benchmarks against a throwaway SQLite database.
+
+Seeds a fresh database (all migrations applied) with --users users owning
+--books books each, then drives /login, /home GET and POST, /delete/<id> and
+/add-notes/<id>, either through the Flask test client or, with --live,
+against a local threaded server hit by --concurrency clients. Reports
+throughput, p50/p95/p99 latency and SQL statements per request.
+
+    python benchmarks/bench_routes.py --users 50 --books 2000 --save baseline.json
+    python benchmarks/bench_routes.py --live --concurrency 8 --compare baseline.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'benchpassword'
+SCENARIOS = ('login', 'home_get', 'home_post', 'update', 'delete')
+
+
+def load_app(database_path):
+    # the app reads its database from the environment at import time
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database_path
+    sys.path.insert(0, BACKEND_DIR)
+    import app as bookie
+    from flask_migrate import upgrade
+
+    bookie.app.config['WTF_CSRF_ENABLED'] = False
+    with bookie.app.app_context():
+        upgrade(directory=os.path.join(BACKEND_DIR, 'migrations'))
+    return bookie
+
+
+def seed(bookie, users, books):
+    """Create the users and their shelves; returns {user_name: [book ids]}."""
+    app, db, User, Book = bookie.app, bookie.db, bookie.User, bookie.Book
+    with app.app_context():
+        password = bookie.hash_password(PASSWORD)
+        db.session.execute(db.insert(User), [
+            {'user_name': 'bench_user_%d' % n, 'password': password} for n in range(users)
+        ])
+        owners = db.session.execute(db.select(User.id, User.user_name)).all()
+        start = datetime.now(timezone.utc) - timedelta(days=365)
+        for owner_id, _ in owners:
+            db.session.execute(db.insert(Book), [{
+                'title': 'Book %d of %d' % (n, owner_id),
+                'author': 'Author %d' % (n % 97),
+                'genre': 'genre-%d' % (n % 11),
+                'rating': 1 + n % 5,
+                'date_created': start + timedelta(minutes=n),
+                'owner_id': owner_id,
+            } for n in range(books)])
+        db.session.commit()
+
+        shelves = {}
+        for owner_id, user_name in owners:
+            shelves[user_name] = list(db.session.execute(
+                db.select(Book.id).where(Book.owner_id == owner_id).order_by(Book.id)).scalars())
+        return shelves
+
+
+class QueryCounter:
+    def __init__(self, bookie):
+        from sqlalchemy import event
+        self.count = 0
+        self._lock = threading.Lock()
+        with bookie.app.app_context():
+            for engine in bookie.db.engines.values():
+                event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def summarize(latencies, queries, elapsed):
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = latencies[0]
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000,
+        'queries_per_request': queries / len(latencies),
+    }
+
+
+class Workload:
+    """Hands out the request for the i-th iteration of a scenario."""
+
+    def __init__(self, shelves):
+        self.users = sorted(shelves)
+        # delete from the back of each shelf and update from the front, so
+        # the two scenarios never touch the same book
+        self.deletable = {user: list(ids) for user, ids in shelves.items()}
+        self.updatable = {user: ids[:len(ids) // 2] for user, ids in shelves.items()}
+        self._lock = threading.Lock()
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+    def request(self, scenario, i, user):
+        if scenario == 'login':
+            return 'POST', '/login', {'username': user, 'password': PASSWORD}
+        if scenario == 'home_get':
+            return 'GET', '/home', None
+        if scenario == 'home_post':
+            return 'POST', '/home', {'book': 'New book %d' % i, 'author': 'Bench', 'genre': 'bench', 'rating': '4'}
+        if scenario == 'update':
+            ids = self.updatable[user]
+            return 'POST', '/add-notes/%d' % ids[i % len(ids)], {'rating': str(1 + i % 5)}
+        if scenario == 'delete':
+            with self._lock:
+                return 'POST', '/delete/%d' % self.deletable[user].pop(), None
+        raise ValueError(scenario)
+
+
+def run_test_client(bookie, workload, counter, scenarios, requests_per_scenario):
+    app = bookie.app
+    clients = {}
+    for user in workload.users:
+        client = app.test_client()
+        client.post('/login', data={'username': user, 'password': PASSWORD})
+        clients[user] = client
+
+    results = {}
+    for scenario in scenarios:
+        latencies = []
+        queries = counter.count
+        started = time.perf_counter()
+        for i in range(requests_per_scenario):
+            user = workload.user(i)
+            # logins use a fresh client so every request really authenticates
+            client = app.test_client() if scenario == 'login' else clients[user]
+            method, path, data = workload.request(scenario, i, user)
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            # /home streams its body, the shelf is only read while it is consumed
+            response.get_data()
+            response.close()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise RuntimeError('%s %s returned %d' % (method, path, response.status_code))
+        results[scenario] = summarize(latencies, counter.count - queries, time.perf_counter() - started)
+    return results
+
+
+def run_live(bookie, workload, counter, scenarios, requests_per_scenario, concurrency):
+    import requests
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, bookie.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    sessions = {}
+    for user in workload.users[:max(concurrency, 1)]:
+        session = requests.Session()
+        session.post(base_url + '/login', data={'username': user, 'password': PASSWORD}, allow_redirects=False)
+        sessions[user] = session
+    users = sorted(sessions)
+
+    def call(scenario, i):
+        user = users[i % len(users)]
+        session = requests.Session() if scenario == 'login' else sessions[user]
+        method, path, data = workload.request(scenario, i, user)
+        start = time.perf_counter()
+        response = session.request(method, base_url + path, data=data, allow_redirects=False)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError('%s %s returned %d' % (method, path, response.status_code))
+        return elapsed
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for scenario in scenarios:
+                queries = counter.count
+                started = time.perf_counter()
+                latencies = list(pool.map(lambda i: call(scenario, i), range(requests_per_scenario)))
+                results[scenario] = summarize(latencies, counter.count - queries, time.perf_counter() - started)
+    finally:
+        server.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print('%-10s %9s %11s %9s %9s %9s %9s' % ('scenario', 'requests', 'req/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for scenario, result in results.items():
+        print('%-10s %9d %11.1f %9.2f %9.2f %9.2f %9.2f' % (
+            scenario, result['requests'], result['throughput'], result['p50_ms'],
+            result['p95_ms'], result['p99_ms'], result['queries_per_request']))
+        previous = (baseline or {}).get(scenario)
+        if previous:
+            changes = ['%s %+.1f%%' % (key, 100.0 * (result[key] - previous[key]) / previous[key])
+                       for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+                       if previous[key]]
+            print('%-10s vs baseline: %s' % ('', ', '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--books', type=int, default=500, help='books per user')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='repeatable, defaults to all')
+    parser.add_argument('--live', action='store_true', help='use a local server instead of the test client')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients with --live')
+    parser.add_argument('--save', metavar='PATH', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare against a saved baseline')
+    args = parser.parse_args()
+
+    scenarios = args.scenario or SCENARIOS
+    if 'delete' in scenarios and args.requests > args.users * (args.books - args.books // 2):
+        parser.error('not enough seeded books for %d deletes' % args.requests)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bookie = load_app(os.path.join(directory, 'bench.db'))
+        shelves = seed(bookie, args.users, args.books)
+        workload = Workload(shelves)
+        counter = QueryCounter(bookie)
+        if args.live:
+            results = run_live(bookie, workload, counter, scenarios, args.requests, args.concurrency)
+        else:
+            results = run_test_client(bookie, workload, counter, scenarios, args.requests)
+
+    mode = 'live' if args.live else 'test_client'
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results'].get(mode)
+    print_results(results, baseline)
+
+    if args.save:
+        report = {
+            'commit': git_commit(),
+            'created': datetime.now(timezone.utc).isoformat(),
+            'options': {key: getattr(args, key) for key in ('users', 'books', 'requests', 'concurrency')},
+            'db_profile': bookie.app.config['DB_PROFILE']['name'],
+            'results': {mode: results},
+        }
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Saved baseline to %s' % args.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""
+Normalized (title, author) keys, so one book typed slightly differently on
+different shelves is recognized as the same book.
+
+Kept free of heavy imports: recommendations and metadata enrichment both
+key their data with it.
+"""
+
+import re
+
+
+_NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+
+def normalize(value):
+    return _NON_WORD.sub(' ', (value or '').casefold()).strip()
+
+
+def item_key(title, author):
+    return '%s|%s' % (normalize(title), normalize(author))
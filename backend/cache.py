@@ -0,0 +1,178 @@
+"""
+Caching for per-user bookshelf data.
+
+Every owner has a version counter that changes whenever their shelf is
+written to. Cached shelves are stored under (owner, version), so bumping the
+version is all it takes to invalidate them, and the version doubles as a
+strong ETag that can be checked without touching the database.
+
+Versions live in the in-process cache by default. Passing a shared backend
+(e.g. RedisBackend) moves them there so every worker sees the same version,
+while shelves are still served from the local LRU when possible.
+
+In-process versions only see the writes made by their own process. They
+expire after the shelf TTL and are replaced by a fresh version, so with
+several workers, or after a CLI command writes to the database, a worker
+can serve a stale shelf or answer a stale ETag with 304 for up to `ttl`
+seconds. Keep the ttl to a few seconds there, or use a shared backend.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+def new_version():
+    # seeded from the clock so a version lost to eviction or a restart is
+    # never handed out again
+    return time.time_ns()
+
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional per-entry time to live."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    # version counters; with a ttl a counter is replaced by a fresh version
+    # once it expires, so a bump made elsewhere is picked up within ttl
+    def _live_version(self, key):
+        entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+            return None
+        return entry[0]
+
+    def _set_version(self, key, version):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (version, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def version(self, key):
+        with self._lock:
+            version = self._live_version(key)
+            if version is None:
+                version = new_version()
+                self._set_version(key, version)
+            else:
+                self._data.move_to_end(key)
+            return version
+
+    def bump(self, key):
+        with self._lock:
+            version = self._live_version(key)
+            version = version + 1 if version is not None else new_version()
+            self._set_version(key, version)
+            return version
+
+
+class RedisBackend:
+    """Shared backend on top of a redis-py client."""
+
+    def __init__(self, client, prefix='bookie:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def version(self, key):
+        key = self.prefix + key
+        self.client.set(key, new_version(), nx=True)
+        return int(self.client.get(key))
+
+    def bump(self, key):
+        key = self.prefix + key
+        self.client.set(key, new_version(), nx=True)
+        return self.client.incr(key)
+
+
+class ShelfCache:
+    def __init__(self, maxsize=256, ttl=300, shared=None):
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.shared = shared
+        self.versions = shared if shared is not None else LRUCache(maxsize * 16, ttl)
+
+    def _version_key(self, owner_id):
+        return 'shelf-version:%d' % owner_id
+
+    def _key(self, owner_id, version):
+        return 'shelf:%d:%d' % (owner_id, version)
+
+    def version(self, owner_id):
+        return self.versions.version(self._version_key(owner_id))
+
+    def etag(self, owner_id, version):
+        return '%d-%d' % (owner_id, version)
+
+    def invalidate(self, owner_id):
+        """Call after every committed write to an owner's shelf."""
+        return self.versions.bump(self._version_key(owner_id))
+
+    def get(self, owner_id, version):
+        key = self._key(owner_id, version)
+        value = self.local.get(key, _MISSING)
+        if value is _MISSING and self.shared is not None:
+            value = self.shared.get(key, _MISSING)
+            if value is not _MISSING:
+                self.local.set(key, value)
+        return None if value is _MISSING else value
+
+    def set(self, owner_id, version, value):
+        key = self._key(owner_id, version)
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl=self.ttl)
@@ -0,0 +1,173 @@
+"""
+Engine profiles for the SQLite database, selected with DB_PROFILE.
+
+`default` keeps SQLAlchemy's stock settings. `production` turns on WAL
+journaling and the pragmas that go with it, sizes the connection pool for
+several gunicorn threads, and adds a read-only engine that GET requests are
+routed to, so page views never wait behind a writer. Individual settings can
+be overridden from the environment, see configure().
+"""
+
+import os
+
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+
+READ_BIND = 'read'
+
+# connection execution option; see install_explicit_begin()
+EXPLICIT_BEGIN = 'explicit_begin'
+
+PROFILES = {
+    'default': {
+        'pragmas': {},
+        'engine_options': {},
+        'read_engine': False,
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+            'mmap_size': 256 * 1024 * 1024,
+            # negative values are KiB rather than pages
+            'cache_size': -64 * 1024,
+        },
+        'engine_options': {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 30,
+            'pool_pre_ping': True,
+        },
+        'read_engine': True,
+    },
+}
+
+# environment overrides: variable -> (section, key, type)
+OVERRIDES = {
+    'SQLITE_BUSY_TIMEOUT': ('pragmas', 'busy_timeout', int),
+    'SQLITE_MMAP_SIZE': ('pragmas', 'mmap_size', int),
+    'SQLITE_CACHE_SIZE': ('pragmas', 'cache_size', int),
+    'SQLITE_SYNCHRONOUS': ('pragmas', 'synchronous', str),
+    'DB_POOL_SIZE': ('engine_options', 'pool_size', int),
+    'DB_MAX_OVERFLOW': ('engine_options', 'max_overflow', int),
+    'DB_POOL_TIMEOUT': ('engine_options', 'pool_timeout', int),
+}
+
+# the read-only engine can't switch the journal mode, it inherits it from the file
+WRITE_ONLY_PRAGMAS = ('journal_mode',)
+
+
+def load_profile(environ=os.environ):
+    name = environ.get('DB_PROFILE', 'default')
+    if name not in PROFILES:
+        raise ValueError('Unknown DB_PROFILE %r, expected one of: %s' % (name, ', '.join(PROFILES)))
+
+    profile = {
+        'name': name,
+        'pragmas': dict(PROFILES[name]['pragmas']),
+        'engine_options': dict(PROFILES[name]['engine_options']),
+        'read_engine': PROFILES[name]['read_engine'],
+    }
+    for variable, (section, key, cast) in OVERRIDES.items():
+        if environ.get(variable):
+            profile[section][key] = cast(environ[variable])
+    if environ.get('DB_READ_ENGINE'):
+        profile['read_engine'] = environ['DB_READ_ENGINE'].lower() in ('1', 'true', 'yes')
+    return profile
+
+
+def read_only_url(url):
+    url = make_url(url)
+    database = url.database
+    if not url.query.get('uri'):
+        database = 'file:' + database
+    return url.set(database=database).update_query_dict({'mode': 'ro', 'uri': 'true'})
+
+
+def configure(app, environ=os.environ):
+    """Fill in the SQLAlchemy config for the selected profile.
+
+    Must run before SQLAlchemy(app); call install_pragmas(db) afterwards.
+    """
+    profile = load_profile(environ)
+    url = environ.get('DATABASE_URL', 'sqlite:///bookie.db')
+
+    app.config['DB_PROFILE'] = profile
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = profile['engine_options']
+    if profile['read_engine'] and make_url(url).get_backend_name() == 'sqlite':
+        app.config['SQLALCHEMY_BINDS'] = {
+            READ_BIND: dict(profile['engine_options'], url=read_only_url(url)),
+        }
+
+
+def install_pragmas(app, db):
+    pragmas = app.config['DB_PROFILE']['pragmas']
+    if not pragmas:
+        return
+
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.url.get_backend_name() != 'sqlite':
+                continue
+            if key == READ_BIND:
+                engine_pragmas = {name: value for name, value in pragmas.items()
+                                  if name not in WRITE_ONLY_PRAGMAS}
+                engine_pragmas['query_only'] = 'ON'
+            else:
+                engine_pragmas = pragmas
+            event.listen(engine, 'connect', _pragma_setter(engine_pragmas))
+
+
+def install_explicit_begin(app, db):
+    """Lets a connection opt in to a real BEGIN with EXPLICIT_BEGIN.
+
+    pysqlite only opens a transaction before the first INSERT, UPDATE or
+    DELETE, so a SAVEPOINT issued first becomes the outer transaction and
+    its RELEASE commits. Code that nests savepoints (the importer) sets the
+    option to have the transaction begun up front. Other connections keep
+    pysqlite's lazy begin, so plain reads never hold a lock.
+    """
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if key != READ_BIND and engine.url.get_backend_name() == 'sqlite':
+                event.listen(engine, 'begin', _explicit_begin)
+
+
+def _explicit_begin(conn):
+    if conn.get_execution_options().get(EXPLICIT_BEGIN):
+        conn.exec_driver_sql('BEGIN')
+
+
+def _pragma_setter(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return set_pragmas
+
+
+class RoutingSession(Session):
+    """Sends the reads of GET and HEAD requests to the read-only engine.
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the writer, as
+    does everything outside a request (CLI commands, migrations, workers).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and not isinstance(clause, UpdateBase)
+            and READ_BIND in self._db.engines
+            and has_request_context()
+            and request.method in ('GET', 'HEAD')
+        ):
+            return self._db.engines[READ_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -0,0 +1,246 @@
+"""
+Background enrichment of book metadata from an HTTP endpoint.
+
+New books are looked up by title and author on METADATA_URL, which answers
+GET ?title=...&author=... with a JSON object holding any of `genre`, `isbn`
+and `cover_url` (404 when it knows nothing about the book). Only fields the
+book is missing are filled in, so nothing a user typed is overwritten.
+
+Lookups run on a small thread pool, each worker keeping its own keep-alive
+session, and requests to a host are spaced out by a per-host rate limit.
+Answers are kept in an on-disk sqlite cache keyed by normalized title and
+author, so the same book on a thousand shelves costs one request, and
+concurrent lookups of one key share a single request.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import text
+from urllib3.util.retry import Retry
+
+from booknames import item_key
+
+
+FIELDS = ('genre', 'isbn', 'cover_url')
+
+# bounded by the widths of the book columns
+FIELD_LENGTHS = {'genre': 100, 'isbn': 20, 'cover_url': 500}
+
+
+class MetadataCache:
+    """Lookup results on disk; misses are remembered for `miss_ttl` seconds."""
+
+    def __init__(self, path, miss_ttl=86400):
+        self.miss_ttl = miss_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                           'key TEXT PRIMARY KEY, payload TEXT, fetched_at REAL NOT NULL)')
+
+    def get(self, key):
+        """Returns (found, metadata); metadata is None for a remembered miss."""
+        with self._lock:
+            row = self._conn.execute('SELECT payload, fetched_at FROM metadata WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        payload, fetched_at = row
+        if payload is None:
+            if time.time() - fetched_at > self.miss_ttl:
+                return False, None
+            return True, None
+        return True, json.loads(payload)
+
+    def set(self, key, metadata):
+        payload = None if metadata is None else json.dumps(metadata)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO metadata (key, payload, fetched_at) VALUES (?, ?, ?)',
+                               (key, payload, time.time()))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT count(*) FROM metadata').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RateLimiter:
+    """Spaces requests to each host at least 1/rate seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(host, now))
+            self._next[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class MetadataClient:
+    """Fetches metadata over per-thread pooled sessions."""
+
+    def __init__(self, url, rate=5.0, timeout=5.0, pool_size=4, retries=2):
+        self.url = url
+        self.host = urlsplit(url).netloc
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.limiter = RateLimiter(rate)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            retry = Retry(total=self.retries, backoff_factor=0.2, allowed_methods=['GET'],
+                          status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept'] = 'application/json'
+            self._local.session = session
+        return session
+
+    def fetch(self, title, author):
+        """Returns the known fields for a book, or None if it is unknown."""
+        self.limiter.wait(self.host)
+        response = self.session.get(self.url, params={'title': title, 'author': author}, timeout=self.timeout)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        body = response.json()
+        metadata = {}
+        for field in FIELDS:
+            value = str(body.get(field) or '').strip()
+            if value:
+                metadata[field] = value[:FIELD_LENGTHS[field]]
+        return metadata or None
+
+
+class Enricher:
+    """Looks up books on a bounded pool and hands results to `apply`.
+
+    apply(book_id, title, author, metadata) runs on the worker thread. At most
+    `max_pending` books wait at once; submit() drops books beyond that
+    rather than block, they are picked up by the next backfill.
+    """
+
+    def __init__(self, client, cache, apply, workers=4, max_pending=1000):
+        self.client = client
+        self.cache = cache
+        self.apply = apply
+        self.requests = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='enrich')
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, title, author):
+        key = item_key(title, author)
+        found, metadata = self.cache.get(key)
+        if found:
+            return metadata
+
+        with self._lock:
+            shared = self._inflight.get(key)
+            if shared is None:
+                shared = self._inflight[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return shared.result()
+
+        try:
+            # a lookup that finished since our miss may have filled the cache
+            found, metadata = self.cache.get(key)
+            if not found:
+                with self._lock:
+                    self.requests += 1
+                metadata = self.client.fetch(title, author)
+                self.cache.set(key, metadata)
+            shared.set_result(metadata)
+            return metadata
+        except BaseException as e:
+            shared.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _run(self, book_id, title, author):
+        try:
+            metadata = self.lookup(title, author)
+            if metadata:
+                self.apply(book_id, title, author, metadata)
+            return metadata
+        finally:
+            self._pending.release()
+
+    def submit(self, book_id, title, author, block=False):
+        """Queues a book; returns its future, or None if the queue is full."""
+        if not self._pending.acquire(blocking=block):
+            return None
+        try:
+            return self._pool.submit(self._run, book_id, title, author)
+        except BaseException:
+            self._pending.release()
+            raise
+
+    def submit_many(self, books, callback=None):
+        """Queues (book_id, title, author) tuples from a background thread.
+
+        The thread waits for room in the queue, so a large import is
+        enriched in full without holding up the request that made it.
+        """
+        def feed():
+            for book_id, title, author in books:
+                future = self.submit(book_id, title, author, block=True)
+                if callback is not None:
+                    future.add_done_callback(callback)
+
+        thread = threading.Thread(target=feed, name='enrich-feed', daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+        self.cache.close()
+
+
+def apply_metadata(conn, book_id, title, author, metadata):
+    """Fills the book's empty fields; returns its owner if anything changed.
+
+    The title and author that were looked up must still match: the book may
+    have been edited while queued, or deleted and its id reused by another.
+    """
+    values = {field: metadata.get(field) for field in FIELDS}
+    row = conn.execute(text(
+        "UPDATE book SET "
+        "genre = CASE WHEN genre IS NULL OR genre = '' THEN COALESCE(:genre, genre) ELSE genre END, "
+        "isbn = COALESCE(isbn, :isbn), "
+        "cover_url = COALESCE(cover_url, :cover_url) "
+        "WHERE id = :id AND title = :title AND author = :author AND ("
+        "((genre IS NULL OR genre = '') AND :genre IS NOT NULL) OR "
+        "(isbn IS NULL AND :isbn IS NOT NULL) OR "
+        "(cover_url IS NULL AND :cover_url IS NOT NULL)) "
+        "RETURNING owner_id"
+    ), dict(values, id=book_id, title=title, author=author)).first()
+    return None if row is None else row[0]
@@ -0,0 +1,189 @@
+"""
+Streaming bulk import of bookshelves from CSV (Goodreads exports included)
+or JSONL files.
+
+Rows are read one at a time, validated, and written in executemany batches,
+so memory use depends on the batch size and not on the size of the file.
+"""
+
+import csv
+import json
+
+from sqlalchemy.exc import IntegrityError
+
+
+# header aliases -> Book column, compared after normalize_key()
+FIELD_ALIASES = {
+    'title': 'title',
+    'author': 'author',
+    'genre': 'genre',
+    'bookshelves': 'genre',
+    'rating': 'rating',
+    'my_rating': 'rating',
+    'date_created': 'date_created',
+    'date_added': 'date_created',
+}
+
+FORMATS = ('csv', 'jsonl')
+
+
+class RowError(ValueError):
+    pass
+
+
+def normalize_key(key):
+    return (key or '').strip().lower().replace(' ', '_')
+
+
+def detect_format(filename):
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return None
+
+
+def iter_records(stream, fmt):
+    """Yield (line_number, record) pairs from a binary stream.
+
+    Records are dicts keyed by Book column name; unknown columns are dropped.
+    Lines that can't be parsed at all are yielded as RowError instances so
+    the caller can report them alongside validation errors. A CSV file that
+    stops being valid UTF-8 can't be resynchronized, so reading ends there
+    with a RowError; JSONL lines are decoded, and rejected, one at a time.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(_decode_lines(stream))
+        try:
+            for record in reader:
+                yield reader.line_num, _map_fields(record)
+        except UnicodeDecodeError as e:
+            yield reader.line_num + 1, RowError('invalid UTF-8: %s' % e)
+    elif fmt == 'jsonl':
+        for line_number, raw in enumerate(stream, start=1):
+            try:
+                line = _decode_line(raw, line_number)
+            except UnicodeDecodeError as e:
+                yield line_number, RowError('invalid UTF-8: %s' % e)
+                continue
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, RowError('invalid JSON: %s' % e)
+                continue
+            if not isinstance(record, dict):
+                yield line_number, RowError('expected a JSON object')
+                continue
+            yield line_number, _map_fields(record)
+    else:
+        raise ValueError('Unsupported import format: %r' % fmt)
+
+
+def _decode_line(raw, line_number):
+    # the first line may carry a byte order mark
+    return raw.decode('utf-8-sig' if line_number == 1 else 'utf-8')
+
+
+def _decode_lines(stream):
+    # decoded a line at a time, so a bad byte is reported on its own line
+    for line_number, raw in enumerate(stream, start=1):
+        yield _decode_line(raw, line_number)
+
+
+def _map_fields(record):
+    mapped = {}
+    for key, value in record.items():
+        key = normalize_key(key)
+        column = FIELD_ALIASES.get(key)
+        # first alias wins, e.g. an explicit genre over Goodreads bookshelves
+        if column and column not in mapped:
+            if key == 'bookshelves':
+                # a comma separated list of shelves, keep the first one
+                value = str(value or '').split(',')[0]
+            mapped[column] = value
+    return mapped
+
+
+class ImportReport:
+    def __init__(self, max_errors):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def add_error(self, line_number, message):
+        self.failed += 1
+        # keep the report bounded no matter how bad the file is
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line_number, 'error': str(message)})
+
+    def to_dict(self):
+        return {'imported': self.imported, 'failed': self.failed, 'errors': self.errors}
+
+
+def import_records(session, insert_stmt, records, validate,
+                   batch_size=500, commit_size=5000, max_errors=100, connection_options=None):
+    """Validate and insert `records` from iter_records().
+
+    `validate` turns a record into a dict of column values or raises
+    ValueError. Valid rows are inserted `batch_size` at a time and the
+    session is committed every `commit_size` rows. A batch rejected by the
+    database is retried row by row so only the offending rows are reported.
+
+    Batches run in savepoints, which need the surrounding transaction to
+    have really begun; `connection_options` are set on the connection of
+    every transaction so the engine can make sure it does (see
+    database.install_explicit_begin).
+    """
+    report = ImportReport(max_errors)
+    batch = []
+    uncommitted = 0
+
+    def begin():
+        session.connection(execution_options=connection_options)
+
+    # the options only apply to a connection the session has yet to open
+    session.commit()
+    begin()
+
+    def flush():
+        nonlocal uncommitted
+        if not batch:
+            return
+        try:
+            with session.begin_nested():
+                session.execute(insert_stmt, [values for _, values in batch])
+            report.imported += len(batch)
+        except IntegrityError:
+            for line_number, values in batch:
+                try:
+                    with session.begin_nested():
+                        session.execute(insert_stmt, [values])
+                    report.imported += 1
+                except IntegrityError as e:
+                    report.add_error(line_number, e.orig)
+        uncommitted += len(batch)
+        batch.clear()
+        if uncommitted >= commit_size:
+            session.commit()
+            begin()
+            uncommitted = 0
+
+    for line_number, record in records:
+        if isinstance(record, Exception):
+            report.add_error(line_number, record)
+            continue
+        try:
+            batch.append((line_number, validate(record)))
+        except ValueError as e:
+            report.add_error(line_number, e)
+            continue
+        if len(batch) >= batch_size:
+            flush()
+
+    flush()
+    session.commit()
+    return report
@@ -0,0 +1,196 @@
+"""
+Per-request instrumentation exposed in the Prometheus text format.
+
+init_app() records, for every request, its latency by route and method, the
+number and total time of the SQL statements it ran (from SQLAlchemy engine
+events) and the time spent rendering templates, and serves the totals at
+/metrics. With SLOW_REQUEST_MS set, requests slower than that are logged
+together with the SQL they issued.
+"""
+
+import functools
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 100
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = defaultdict(float)
+
+    def inc(self, labels, amount=1):
+        self.values[labels] += amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name + _labels(self.labels, labels), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        # labels -> [per-bucket counts, sum, count]
+        self.values = {}
+
+    def observe(self, labels, value):
+        entry = self.values.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, observed) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + '_bucket' + _labels(self.labels, labels, 'le="%s"' % bound), count
+            yield self.name + '_bucket' + _labels(self.labels, labels, 'le="+Inf"'), observed
+            yield self.name + '_sum' + _labels(self.labels, labels), total
+            yield self.name + '_count' + _labels(self.labels, labels), observed
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter(
+            'bookie_requests_total', 'Requests handled.', ('route', 'method', 'status'))
+        self.latency = Histogram(
+            'bookie_request_duration_seconds', 'Request latency.', ('route', 'method'), LATENCY_BUCKETS)
+        self.statements = Histogram(
+            'bookie_request_sql_statements', 'SQL statements issued per request.',
+            ('route', 'method'), STATEMENT_BUCKETS)
+        self.sql_time = Counter(
+            'bookie_sql_duration_seconds_total', 'Time spent executing SQL.', ('route', 'method'))
+        self.render_time = Histogram(
+            'bookie_template_render_seconds', 'Template render time.', ('template',), LATENCY_BUCKETS)
+        self.families = (self.requests, self.latency, self.statements, self.sql_time, self.render_time)
+
+    def observe_request(self, route, method, status, seconds, statements, sql_seconds):
+        with self._lock:
+            self.requests.inc((route, method, status))
+            self.latency.observe((route, method), seconds)
+            self.statements.observe((route, method), statements)
+            self.sql_time.inc((route, method), sql_seconds)
+
+    def observe_render(self, template, seconds):
+        with self._lock:
+            self.render_time.observe((template,), seconds)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for family in self.families:
+                lines.append('# HELP %s %s' % (family.name, family.help))
+                lines.append('# TYPE %s %s' % (family.name, family.kind))
+                lines.extend('%s %s' % (name, _number(value)) for name, value in family.samples())
+        return '\n'.join(lines) + '\n'
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def init_app(app, metrics=None):
+    metrics = metrics or Metrics()
+    app.extensions['metrics'] = metrics
+    threshold = app.config.get('SLOW_REQUEST_MS')
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        g.metrics_sql = [0, 0.0]
+        g.metrics_statements = [] if threshold is not None else None
+
+    def finish(route, method, path, status, start, sql, logged):
+        seconds = time.perf_counter() - start
+        count, sql_seconds = sql
+        metrics.observe_request(route, method, status, seconds, count, sql_seconds)
+
+        if threshold is not None and seconds * 1000 >= threshold:
+            statements = ''.join(
+                '\n  %.2f ms  %s' % (duration * 1000, statement)
+                for statement, duration in logged)
+            app.logger.warning('Slow request %s %s: %.1f ms, %d SQL statements (%.1f ms)%s',
+                               method, path, seconds * 1000, count, sql_seconds * 1000, statements)
+
+    @app.after_request
+    def record_on_close(response):
+        # a streamed body (export, the shelf page) runs its queries and renders
+        # after the view returns, so the request is recorded once the server
+        # closes the response; g.metrics_sql keeps counting until then
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            response.call_on_close(functools.partial(
+                finish, _route(), request.method, request.path, response.status_code,
+                start, g.metrics_sql, g.metrics_statements))
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        # only reached with metrics_start set when after_request never ran
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            finish(_route(), request.method, request.path, 500, start, g.metrics_sql, g.metrics_statements)
+
+    # every engine, including the read-only bind
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def finish_statement(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_start'].pop()
+        if not has_request_context() or 'metrics_sql' not in g:
+            return
+        g.metrics_sql[0] += 1
+        g.metrics_sql[1] += seconds
+        logged = g.metrics_statements
+        if logged is not None and len(logged) < MAX_LOGGED_STATEMENTS:
+            logged.append((statement, seconds))
+
+    @before_render_template.connect_via(app)
+    def start_render(sender, template, context, **extra):
+        if has_request_context():
+            g.setdefault('metrics_render', []).append(time.perf_counter())
+
+    @template_rendered.connect_via(app)
+    def finish_render(sender, template, context, **extra):
+        if has_request_context() and g.get('metrics_render'):
+            metrics.observe_render(template.name, time.perf_counter() - g.metrics_render.pop())
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,26 @@
+"""Add composite index for keyset pagination of a user's shelf
+
+Revision ID: 5b1d0c7e9a21
+Revises: 1184003bd9de
+Create Date: 2026-10-18 09:12:03.418227
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1d0c7e9a21'
+down_revision = '1184003bd9de'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.create_index('ix_book_owner_id_date_created', ['owner_id', 'date_created'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.drop_index('ix_book_owner_id_date_created')
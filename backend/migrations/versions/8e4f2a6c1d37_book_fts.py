@@ -0,0 +1,56 @@
+"""Add FTS5 search index over book title, author and genre
+
+Revision ID: 8e4f2a6c1d37
+Revises: 5b1d0c7e9a21
+Create Date: 2026-10-18 10:41:27.905112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4f2a6c1d37'
+down_revision = '5b1d0c7e9a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # owner_id is indexed as a token matched in the query, so FTS5 intersects
+    # the search terms with the owner's books instead of scoring every user's
+    op.execute(
+        "CREATE VIRTUAL TABLE book_fts USING fts5("
+        "title, author, genre, owner_id, "
+        "prefix='2 3', tokenize='unicode61 remove_diacritics 2')"
+    )
+    op.execute(
+        "CREATE TRIGGER book_fts_ai AFTER INSERT ON book BEGIN "
+        "INSERT INTO book_fts (rowid, title, author, genre, owner_id) "
+        "VALUES (new.id, new.title, new.author, new.genre, new.owner_id); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER book_fts_ad AFTER DELETE ON book BEGIN "
+        "DELETE FROM book_fts WHERE rowid = old.id; "
+        "END"
+    )
+    # rating changes don't touch the index
+    op.execute(
+        "CREATE TRIGGER book_fts_au AFTER UPDATE OF title, author, genre, owner_id ON book BEGIN "
+        "DELETE FROM book_fts WHERE rowid = old.id; "
+        "INSERT INTO book_fts (rowid, title, author, genre, owner_id) "
+        "VALUES (new.id, new.title, new.author, new.genre, new.owner_id); "
+        "END"
+    )
+    op.execute(
+        "INSERT INTO book_fts (rowid, title, author, genre, owner_id) "
+        "SELECT id, title, author, genre, owner_id FROM book"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER book_fts_au")
+    op.execute("DROP TRIGGER book_fts_ad")
+    op.execute("DROP TRIGGER book_fts_ai")
+    op.execute("DROP TABLE book_fts")
@@ -0,0 +1,28 @@
+"""Add book.isbn and book.cover_url
+
+Revision ID: a8c4e6f2d195
+Revises: e2b6c8f4a913
+Create Date: 2026-10-18 19:04:11.582307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8c4e6f2d195'
+down_revision = 'e2b6c8f4a913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('isbn', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('cover_url', sa.String(length=500), nullable=True))
+
+
+def downgrade():
+    # plain ALTER TABLE, a batch rebuild of book would drop its triggers
+    op.drop_column('book', 'cover_url')
+    op.drop_column('book', 'isbn')
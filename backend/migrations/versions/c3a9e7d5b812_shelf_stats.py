@@ -0,0 +1,115 @@
+"""Add trigger-maintained reading statistics tables
+
+Revision ID: c3a9e7d5b812
+Revises: 8e4f2a6c1d37
+Create Date: 2026-10-18 13:05:44.270391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a9e7d5b812'
+down_revision = '8e4f2a6c1d37'
+branch_labels = None
+depends_on = None
+
+
+# table, key column, key expression over a book row (prefixed with new./old.),
+# and the extra summed columns
+AGGREGATES = [
+    ('shelf_rating_stats', 'rating', 'CAST({row}.rating AS INTEGER)', {}),
+    ('shelf_genre_stats', 'genre', "COALESCE({row}.genre, '')", {'rating_sum': '{row}.rating'}),
+    ('shelf_month_stats', 'month', "COALESCE(strftime('%Y-%m', {row}.date_created), '')", {}),
+    ('shelf_author_stats', 'author', '{row}.author', {}),
+]
+
+
+def add_sql(table, key, expression, sums):
+    columns = ', '.join(['owner_id', key, 'book_count'] + list(sums))
+    values = ', '.join(['new.owner_id', expression.format(row='new'), '1']
+                       + [value.format(row='new') for value in sums.values()])
+    updates = ', '.join(['book_count = book_count + 1']
+                        + ['%s = %s + excluded.%s' % (column, column, column) for column in sums])
+    return (
+        "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (owner_id, %s) DO UPDATE SET %s;"
+        % (table, columns, values, key, updates)
+    )
+
+
+def remove_sql(table, key, expression, sums):
+    where = "owner_id = old.owner_id AND %s = %s" % (key, expression.format(row='old'))
+    updates = ', '.join(['book_count = book_count - 1']
+                        + ['%s = %s - %s' % (column, column, value.format(row='old'))
+                           for column, value in sums.items()])
+    return (
+        "UPDATE %s SET %s WHERE %s; DELETE FROM %s WHERE %s AND book_count <= 0;"
+        % (table, updates, where, table, where)
+    )
+
+
+def upgrade():
+    op.create_table('shelf_rating_stats',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('rating', sa.Integer(), nullable=False),
+    sa.Column('book_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'rating')
+    )
+    op.create_table('shelf_genre_stats',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('genre', sa.String(length=100), nullable=False),
+    sa.Column('book_count', sa.Integer(), nullable=False),
+    sa.Column('rating_sum', sa.Double(), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'genre')
+    )
+    op.create_table('shelf_month_stats',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.String(length=7), nullable=False),
+    sa.Column('book_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'month')
+    )
+    op.create_table('shelf_author_stats',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('author', sa.String(length=100), nullable=False),
+    sa.Column('book_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'author')
+    )
+    with op.batch_alter_table('shelf_author_stats', schema=None) as batch_op:
+        batch_op.create_index('ix_shelf_author_stats_owner_id_book_count', ['owner_id', 'book_count'], unique=False)
+
+    add = ' '.join(add_sql(*aggregate) for aggregate in AGGREGATES)
+    remove = ' '.join(remove_sql(*aggregate) for aggregate in AGGREGATES)
+    op.execute("CREATE TRIGGER shelf_stats_ai AFTER INSERT ON book BEGIN %s END" % add)
+    op.execute("CREATE TRIGGER shelf_stats_ad AFTER DELETE ON book BEGIN %s END" % remove)
+    op.execute(
+        "CREATE TRIGGER shelf_stats_au AFTER UPDATE OF rating, genre, author, date_created, owner_id "
+        "ON book BEGIN %s %s END" % (remove, add)
+    )
+
+    # backfill from the existing shelves
+    for table, key, expression, sums in AGGREGATES:
+        expression = expression.format(row='book')
+        columns = ', '.join(['owner_id', key, 'book_count'] + list(sums))
+        totals = ''.join(', SUM(%s)' % value.format(row='book') for value in sums.values())
+        op.execute(
+            "INSERT INTO %s (%s) SELECT owner_id, %s, COUNT(*)%s FROM book GROUP BY owner_id, %s"
+            % (table, columns, expression, totals, expression)
+        )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER shelf_stats_au")
+    op.execute("DROP TRIGGER shelf_stats_ad")
+    op.execute("DROP TRIGGER shelf_stats_ai")
+    with op.batch_alter_table('shelf_author_stats', schema=None) as batch_op:
+        batch_op.drop_index('ix_shelf_author_stats_owner_id_book_count')
+
+    op.drop_table('shelf_author_stats')
+    op.drop_table('shelf_month_stats')
+    op.drop_table('shelf_genre_stats')
+    op.drop_table('shelf_rating_stats')
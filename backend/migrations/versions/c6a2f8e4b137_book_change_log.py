@@ -0,0 +1,75 @@
+"""Track writes to book for incremental export
+
+Revision ID: c6a2f8e4b137
+Revises: a8c4e6f2d195
+Create Date: 2026-10-18 20:41:09.774215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6a2f8e4b137'
+down_revision = 'a8c4e6f2d195'
+branch_labels = None
+depends_on = None
+
+
+NEXT_CHANGE = "UPDATE book_change_counter SET value = value + 1 WHERE id = 1;"
+CURRENT_CHANGE = "(SELECT value FROM book_change_counter WHERE id = 1)"
+
+
+def upgrade():
+    op.create_table('book_change_counter',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('deleted_book',
+    sa.Column('book_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('change_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('book_id', 'change_id')
+    )
+    with op.batch_alter_table('deleted_book', schema=None) as batch_op:
+        batch_op.create_index('ix_deleted_book_owner_id_change_id', ['owner_id', 'change_id'], unique=False)
+
+    # plain ALTER TABLE, a batch rebuild of book would drop its triggers
+    op.add_column('book', sa.Column('change_id', sa.Integer(), server_default='0', nullable=False))
+    op.create_index('ix_book_owner_id_change_id', 'book', ['owner_id', 'change_id'], unique=False)
+
+    # existing books are numbered in insert order
+    op.execute("UPDATE book SET change_id = id")
+    op.execute("INSERT INTO book_change_counter (id, value) SELECT 1, COALESCE(MAX(id), 0) FROM book")
+
+    op.execute(
+        "CREATE TRIGGER book_change_ai AFTER INSERT ON book BEGIN %s "
+        "UPDATE book SET change_id = %s WHERE id = new.id; "
+        "END" % (NEXT_CHANGE, CURRENT_CHANGE)
+    )
+    # the WHEN clause skips the trigger's own update of change_id
+    op.execute(
+        "CREATE TRIGGER book_change_au AFTER UPDATE OF title, author, genre, rating, date_created, "
+        "owner_id, isbn, cover_url ON book WHEN new.change_id = old.change_id BEGIN %s "
+        "UPDATE book SET change_id = %s WHERE id = new.id; "
+        "END" % (NEXT_CHANGE, CURRENT_CHANGE)
+    )
+    op.execute(
+        "CREATE TRIGGER book_change_ad AFTER DELETE ON book BEGIN %s "
+        "INSERT INTO deleted_book (book_id, owner_id, change_id) VALUES (old.id, old.owner_id, %s); "
+        "END" % (NEXT_CHANGE, CURRENT_CHANGE)
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER book_change_ad")
+    op.execute("DROP TRIGGER book_change_au")
+    op.execute("DROP TRIGGER book_change_ai")
+    op.drop_index('ix_book_owner_id_change_id', table_name='book')
+    op.drop_column('book', 'change_id')
+    with op.batch_alter_table('deleted_book', schema=None) as batch_op:
+        batch_op.drop_index('ix_deleted_book_owner_id_change_id')
+
+    op.drop_table('deleted_book')
+    op.drop_table('book_change_counter')
@@ -0,0 +1,36 @@
+"""Unique index on user_name, room for password hashes
+
+Revision ID: d7f1b4a2e690
+Revises: c3a9e7d5b812
+Create Date: 2026-10-18 14:22:10.533870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f1b4a2e690'
+down_revision = 'c3a9e7d5b812'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing plain text and bcrypt passwords are rehashed with the configured
+    # method on the user's next login (bcrypt ones only if bcrypt is installed)
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('password',
+               existing_type=sa.String(length=30),
+               type_=sa.String(length=255),
+               existing_nullable=False)
+        batch_op.create_index(batch_op.f('ix_user_user_name'), ['user_name'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_user_name'))
+        batch_op.alter_column('password',
+               existing_type=sa.String(length=255),
+               type_=sa.String(length=30),
+               existing_nullable=False)
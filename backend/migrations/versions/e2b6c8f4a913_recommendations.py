@@ -0,0 +1,66 @@
+"""Add item-item recommendation tables
+
+Revision ID: e2b6c8f4a913
+Revises: d7f1b4a2e690
+Create Date: 2026-10-18 16:48:31.662047
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b6c8f4a913'
+down_revision = 'd7f1b4a2e690'
+branch_labels = None
+depends_on = None
+
+
+def mark_dirty(row):
+    return (
+        "INSERT INTO rec_dirty_owner (owner_id, generation) VALUES (%s.owner_id, 1) "
+        "ON CONFLICT (owner_id) DO UPDATE SET generation = generation + 1;" % row
+    )
+
+
+def upgrade():
+    op.create_table('rec_item',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('item_key', sa.String(length=205), nullable=False),
+    sa.Column('title', sa.String(length=100), nullable=False),
+    sa.Column('author', sa.String(length=100), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('rec_item', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_rec_item_item_key'), ['item_key'], unique=True)
+
+    op.create_table('rec_neighbor',
+    sa.Column('item_id', sa.Integer(), nullable=False),
+    sa.Column('neighbor_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Double(), nullable=False),
+    sa.PrimaryKeyConstraint('item_id', 'neighbor_id')
+    )
+    op.create_table('rec_dirty_owner',
+    sa.Column('owner_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('generation', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('owner_id')
+    )
+
+    op.execute("CREATE TRIGGER rec_dirty_ai AFTER INSERT ON book BEGIN %s END" % mark_dirty('new'))
+    op.execute("CREATE TRIGGER rec_dirty_ad AFTER DELETE ON book BEGIN %s END" % mark_dirty('old'))
+    op.execute(
+        "CREATE TRIGGER rec_dirty_au AFTER UPDATE OF title, author, rating, owner_id ON book BEGIN %s %s END"
+        % (mark_dirty('old'), mark_dirty('new'))
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER rec_dirty_au")
+    op.execute("DROP TRIGGER rec_dirty_ad")
+    op.execute("DROP TRIGGER rec_dirty_ai")
+    op.drop_table('rec_dirty_owner')
+    op.drop_table('rec_neighbor')
+    with op.batch_alter_table('rec_item', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_rec_item_item_key'))
+
+    op.drop_table('rec_item')
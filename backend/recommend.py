@@ -0,0 +1,422 @@
+"""
+"Readers like you" recommendations from the ratings on every shelf.
+
+Books are matched across users by normalized (title, author). Training
+builds a sparse user x item matrix of mean-centered ratings and computes
+item-item cosine similarities (adjusted cosine) in blocks of sparse matrix
+products, keeping the top k neighbours of every item in `rec_neighbor`.
+Requests are served from that table with a couple of indexed queries.
+
+Writes to `book` mark their owner in `rec_dirty_owner` (by trigger).
+refresh() rebuilds only those users' rows of the matrix and recomputes the
+neighbour lists that can have changed, instead of retraining everything.
+The matrix and neighbour lists are kept between runs in a .npz state file.
+"""
+
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import bindparam, text
+
+from booknames import item_key
+
+
+# dense similarity elements computed at once, bounds training memory
+BLOCK_ELEMENTS = 1 << 22
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class Model:
+    """Training state: the rating matrix and every item's neighbour list.
+
+    Lists hold up to `capacity` neighbours although only the best `k` are
+    served; `floor[i]` bounds the score of any item missing from list i.
+    The spare entries let refresh() patch most lists instead of recomputing
+    them when a neighbour's score drops.
+    """
+
+    def __init__(self, matrix, user_ids, item_keys, neighbors, scores, floor, k):
+        self.matrix = matrix.tocsr()
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.item_keys = list(item_keys)
+        self.key_index = {key: i for i, key in enumerate(self.item_keys)}
+        self.neighbors = neighbors
+        self.scores = scores
+        self.floor = floor
+        self.k = k
+
+    @property
+    def capacity(self):
+        return self.neighbors.shape[1]
+
+    @classmethod
+    def empty(cls, k, capacity):
+        return cls(sp.csr_matrix((0, 0)), [], [], np.full((0, capacity), -1, dtype=np.int64),
+                   np.zeros((0, capacity)), np.zeros(0), k)
+
+    def save(self, path):
+        matrix = self.matrix
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                 shape=np.array(matrix.shape), user_ids=self.user_ids,
+                 item_keys=np.array(self.item_keys, dtype=str), neighbors=self.neighbors,
+                 scores=self.scores, floor=self.floor, k=np.array(self.k))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            matrix = sp.csr_matrix((state['data'], state['indices'], state['indptr']), shape=tuple(state['shape']))
+            return cls(matrix, state['user_ids'], state['item_keys'].tolist(), state['neighbors'],
+                       state['scores'], state['floor'], int(state['k']))
+
+    def add_items(self, keys):
+        new = [key for key in dict.fromkeys(keys) if key not in self.key_index]
+        for key in new:
+            self.key_index[key] = len(self.item_keys)
+            self.item_keys.append(key)
+        if new:
+            n_items = len(self.item_keys)
+            self.matrix = sp.csr_matrix(
+                (self.matrix.data, self.matrix.indices, self.matrix.indptr),
+                shape=(self.matrix.shape[0], n_items))
+            self.neighbors = np.vstack([self.neighbors, np.full((len(new), self.capacity), -1, dtype=np.int64)])
+            self.scores = np.vstack([self.scores, np.zeros((len(new), self.capacity))])
+            self.floor = np.concatenate([self.floor, np.zeros(len(new))])
+        return new
+
+    def column_norms(self):
+        return np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=0))).ravel()
+
+
+def _centered_rows(shelves, key_index):
+    """Build CSR rows of mean-centered ratings for {owner: {key: rating}}."""
+    indptr, indices, data = [0], [], []
+    for ratings in shelves.values():
+        if ratings:
+            mean = sum(ratings.values()) / len(ratings)
+            for key, rating in ratings.items():
+                indices.append(key_index[key])
+                data.append(rating - mean)
+        indptr.append(len(indices))
+    return sp.csr_matrix((data, indices, indptr), shape=(len(shelves), len(key_index)))
+
+
+def _inverse(norms):
+    return np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+
+
+def _top_neighbors(model, items, norms):
+    """Best `capacity` cosine neighbours of `items`, computing one block of
+    X[:, block].T @ X at a time. Sets their lists and floors in place."""
+    n_items = len(model.item_keys)
+    if not len(items) or not n_items:
+        return
+
+    columns = model.matrix.tocsc()
+    inverse = _inverse(norms)
+    block_size = max(1, BLOCK_ELEMENTS // n_items)
+    keep = min(model.capacity, n_items)
+
+    for start in range(0, len(items), block_size):
+        block = np.asarray(items[start:start + block_size])
+        sims = (columns[:, block].T @ model.matrix).toarray()
+        sims *= inverse[block][:, None] * inverse[None, :]
+        sims[np.arange(len(block)), block] = 0.0
+        sims[sims < 0] = 0.0
+
+        top = np.argpartition(-sims, keep - 1, axis=1)[:, :keep]
+        top_scores = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        model.neighbors[block] = -1
+        model.scores[block] = 0.0
+        model.neighbors[block, :keep] = np.where(top_scores > 0, top, -1)
+        model.scores[block, :keep] = top_scores
+        # a full list may have left out items scoring up to its last entry
+        model.floor[block] = model.scores[block, -1]
+
+
+def fit(shelves, k, capacity):
+    """Train from scratch on {owner_id: {item key: rating}}."""
+    model = Model.empty(k, capacity)
+    model.add_items(key for ratings in shelves.values() for key in ratings)
+    model.matrix = _centered_rows(shelves, model.key_index)
+    model.user_ids = np.fromiter(shelves, dtype=np.int64, count=len(shelves))
+    _top_neighbors(model, np.arange(len(model.item_keys)), model.column_norms())
+    return model
+
+
+def _patch(model, item, kept, candidates, candidate_scores):
+    """Swap fresh scores against the affected items into an item's list;
+    `kept` masks the entries that aren't affected.
+
+    Returns False when the served top k can no longer be trusted, i.e. an
+    item outside the list might now belong in it.
+    """
+    ids = np.concatenate([model.neighbors[item][kept], candidates])
+    values = np.concatenate([model.scores[item][kept], candidate_scores])
+    order = np.argsort(-values, kind='stable')
+    stored, dropped = order[:model.capacity], order[model.capacity:]
+    if len(dropped):
+        model.floor[item] = max(model.floor[item], values[dropped].max())
+
+    model.neighbors[item] = -1
+    model.scores[item] = 0.0
+    model.neighbors[item, :len(stored)] = ids[stored]
+    model.scores[item, :len(stored)] = values[stored]
+
+    if model.floor[item] <= 0:
+        return True
+    return len(stored) >= model.k and model.scores[item, model.k - 1] >= model.floor[item]
+
+
+def refresh(model, shelves):
+    """Apply the current shelves of some owners to a trained model.
+
+    Only the columns those owners touch change ("affected" items), and only
+    similarities involving an affected item move. Affected items get their
+    lists recomputed; every other item that is similar to one, or lists
+    one, has just those scores patched in, and is recomputed only when the
+    patch can't guarantee its top k. Returns the ids of items whose served
+    neighbours changed.
+    """
+    model.add_items(key for ratings in shelves.values() for key in ratings)
+    owner_ids = np.fromiter(shelves, dtype=np.int64, count=len(shelves))
+
+    dirty = np.isin(model.user_ids, owner_ids)
+    old_rows = model.matrix[dirty]
+    new_rows = _centered_rows(shelves, model.key_index)
+    affected = np.union1d(old_rows.indices, new_rows.indices).astype(np.int64)
+
+    model.matrix = sp.vstack([model.matrix[~dirty], new_rows], format='csr')
+    model.user_ids = np.concatenate([model.user_ids[~dirty], owner_ids])
+    if not len(affected):
+        return set()
+
+    k = model.k
+    served_before = model.neighbors[:, :k].copy(), model.scores[:, :k].copy()
+
+    # similarity of every item to each affected item, one sparse product
+    norms = model.column_norms()
+    inverse = _inverse(norms)
+    sims = (model.matrix.tocsc()[:, affected].T @ model.matrix).tocsr()
+    sims = sp.csr_matrix(sims.multiply(inverse[affected][:, None]).multiply(inverse[None, :])).T.tocsr()
+
+    recompute = np.zeros(len(model.item_keys), dtype=bool)
+    recompute[affected] = True
+    listed = model.neighbors >= 0
+    listed_affected = listed & recompute[np.where(listed, model.neighbors, 0)]
+    touched = listed_affected.any(axis=1)
+    touched[np.flatnonzero(np.diff(sims.indptr))] = True
+    touched &= ~recompute
+
+    for item in np.flatnonzero(touched):
+        row = slice(sims.indptr[item], sims.indptr[item + 1])
+        values = sims.data[row]
+        positive = values > 0
+        kept = listed[item] & ~listed_affected[item]
+        if not _patch(model, item, kept, affected[sims.indices[row][positive]], values[positive]):
+            recompute[item] = True
+
+    _top_neighbors(model, np.flatnonzero(recompute), norms)
+
+    candidates = np.flatnonzero(touched | recompute)
+    before_ids, before_scores = served_before[0][candidates], served_before[1][candidates]
+    same = (model.neighbors[candidates, :k] == before_ids).all(axis=1) & \
+        np.isclose(model.scores[candidates, :k], before_scores).all(axis=1)
+    return set(candidates[~same].tolist())
+
+
+# database side
+
+def read_shelves(conn, owner_ids=None):
+    """{owner_id: {item key: rating}} plus {item key: (title, author)}."""
+    query = "SELECT owner_id, title, author, rating FROM book"
+    batches = [None]
+    if owner_ids is not None:
+        query += " WHERE owner_id IN :owner_ids"
+        batches = list(_chunks(owner_ids))
+        shelves = {owner_id: {} for owner_id in owner_ids}
+    else:
+        shelves = {}
+
+    catalog = {}
+    for batch in batches:
+        statement = text(query)
+        params = {}
+        if batch is not None:
+            statement = statement.bindparams(_expanding('owner_ids'))
+            params = {'owner_ids': batch}
+        counts = {}
+        for owner_id, title, author, rating in conn.execute(statement, params):
+            key = item_key(title, author)
+            catalog.setdefault(key, (title, author))
+            ratings = shelves.setdefault(owner_id, {})
+            # the same book twice on a shelf counts once, at its average rating
+            n = counts.get((owner_id, key), 0)
+            ratings[key] = (ratings.get(key, 0.0) * n + rating) / (n + 1)
+            counts[(owner_id, key)] = n + 1
+    return shelves, catalog
+
+
+def _expanding(name):
+    return bindparam(name, expanding=True)
+
+
+def _insert_items(conn, model, catalog, keys):
+    rows = []
+    for key in keys:
+        title, author = catalog[key]
+        rows.append({'id': model.key_index[key], 'item_key': key, 'title': title, 'author': author})
+    if rows:
+        conn.execute(text("INSERT INTO rec_item (id, item_key, title, author) "
+                          "VALUES (:id, :item_key, :title, :author)"), rows)
+
+
+def _served(model, item):
+    neighbors, scores = model.neighbors[item, :model.k], model.scores[item, :model.k]
+    return {int(n): float(s) for n, s in zip(neighbors, scores) if n >= 0}
+
+
+def _write_all(conn, model, catalog):
+    conn.execute(text("DELETE FROM rec_neighbor"))
+    conn.execute(text("DELETE FROM rec_item"))
+    _insert_items(conn, model, catalog, model.item_keys)
+    pairs = [
+        {'item_id': item, 'neighbor_id': neighbor, 'score': score}
+        for item in range(len(model.item_keys))
+        for neighbor, score in _served(model, item).items()
+    ]
+    if pairs:
+        conn.execute(text("INSERT INTO rec_neighbor (item_id, neighbor_id, score) "
+                          "VALUES (:item_id, :neighbor_id, :score)"), pairs)
+
+
+def _write_changes(conn, model, catalog, new_keys, before, items):
+    """Write only the (item, neighbour) pairs that differ from `before`."""
+    _insert_items(conn, model, catalog, new_keys)
+    removed, upserts = [], []
+    for item in items:
+        old = before.get(item, {})
+        new = _served(model, item)
+        removed.extend({'item_id': item, 'neighbor_id': n} for n in old.keys() - new.keys())
+        upserts.extend({'item_id': item, 'neighbor_id': n, 'score': score}
+                       for n, score in new.items() if old.get(n) != score)
+    if removed:
+        conn.execute(text("DELETE FROM rec_neighbor WHERE item_id = :item_id AND neighbor_id = :neighbor_id"),
+                     removed)
+    if upserts:
+        conn.execute(text("INSERT INTO rec_neighbor (item_id, neighbor_id, score) "
+                          "VALUES (:item_id, :neighbor_id, :score) "
+                          "ON CONFLICT (item_id, neighbor_id) DO UPDATE SET score = excluded.score"), upserts)
+
+
+def _dirty_owners(conn):
+    return dict(conn.execute(text("SELECT owner_id, generation FROM rec_dirty_owner")).all())
+
+
+def _clear_dirty(conn, dirty):
+    # an owner marked again while we worked keeps its (newer) generation
+    if dirty:
+        conn.execute(text("DELETE FROM rec_dirty_owner WHERE owner_id = :owner_id AND generation = :generation"),
+                     [{'owner_id': owner_id, 'generation': generation} for owner_id, generation in dirty.items()])
+
+
+def train(engine, state_path, k, capacity=None):
+    """Retrain from scratch and replace the neighbour table. Returns the item count.
+
+    `capacity` is how many neighbours are kept per book (default 2k), see Model.
+    """
+    with engine.connect() as conn:
+        dirty = _dirty_owners(conn)
+        shelves, catalog = read_shelves(conn)
+
+    model = fit(shelves, k, capacity or 2 * k)
+    with engine.begin() as conn:
+        _write_all(conn, model, catalog)
+        _clear_dirty(conn, dirty)
+    model.save(state_path)
+    return len(model.item_keys)
+
+
+def update(engine, state_path, k, capacity=None):
+    """Fold the shelves changed since the last run into the model.
+
+    Falls back to train() when there is no saved state, or when it was
+    trained with a different k or capacity. Returns (count, retrained):
+    the item count from train() if it retrained, otherwise the number of
+    neighbour lists that changed.
+    """
+    model = Model.load(state_path) if os.path.exists(state_path) else None
+    if model is None or model.k != k or model.capacity != (capacity or 2 * k):
+        return train(engine, state_path, k, capacity), True
+
+    with engine.connect() as conn:
+        # read the marks before the shelves, so later writes mark them again
+        dirty = _dirty_owners(conn)
+        if not dirty:
+            return 0, False
+        shelves, catalog = read_shelves(conn, list(dirty))
+
+    n_keys = len(model.item_keys)
+    served_before = model.neighbors[:, :model.k].copy(), model.scores[:, :model.k].copy()
+    changed = refresh(model, shelves)
+    before = {item: {int(n): float(s) for n, s in zip(*(served[item] for served in served_before)) if n >= 0}
+              for item in changed if item < n_keys}
+    with engine.begin() as conn:
+        _write_changes(conn, model, catalog, model.item_keys[n_keys:], before, sorted(changed))
+        _clear_dirty(conn, dirty)
+    model.save(state_path)
+    return len(changed), False
+
+
+def recommendations(conn, owner_id, limit=10):
+    """Predict ratings for books near the owner's shelf, best first."""
+    shelves, _ = read_shelves(conn, [owner_id])
+    ratings = shelves.get(owner_id)
+    if not ratings:
+        return []
+    mean = sum(ratings.values()) / len(ratings)
+
+    items = {}
+    for batch in _chunks(ratings):
+        query = text("SELECT id, item_key FROM rec_item WHERE item_key IN :keys").bindparams(_expanding('keys'))
+        for item_id, key in conn.execute(query, {'keys': batch}):
+            items[item_id] = ratings[key] - mean
+
+    # candidate -> [weighted deviation, total similarity]
+    totals = {}
+    for batch in _chunks(items):
+        query = text("SELECT item_id, neighbor_id, score FROM rec_neighbor "
+                     "WHERE item_id IN :ids").bindparams(_expanding('ids'))
+        for item_id, neighbor_id, score in conn.execute(query, {'ids': batch}):
+            if neighbor_id in items:
+                continue
+            total = totals.setdefault(neighbor_id, [0.0, 0.0])
+            total[0] += score * items[item_id]
+            total[1] += score
+
+    ranked = sorted(totals.items(), key=lambda item: (-(item[1][0] / item[1][1]), -item[1][1]))[:limit]
+    if not ranked:
+        return []
+
+    query = text("SELECT id, title, author FROM rec_item WHERE id IN :ids").bindparams(_expanding('ids'))
+    details = {row.id: row for row in conn.execute(query, {'ids': [item_id for item_id, _ in ranked]})}
+    return [
+        {
+            'title': details[item_id].title,
+            'author': details[item_id].author,
+            'predicted_rating': round(min(max(mean + weighted / similarity, 1.0), 5.0), 2),
+            'similarity': round(similarity, 4),
+        }
+        for item_id, (weighted, similarity) in ranked
+    ]
@@ -0,0 +1,82 @@
+"""
+Full-text search over the bookshelf, backed by the `book_fts` FTS5 table.
+
+The table and the triggers that keep it in sync with `book` are created by
+the `book_fts` migration; this module only builds queries against it and
+backfills it.
+"""
+
+import re
+
+from sqlalchemy import text
+
+
+FTS_TABLE = 'book_fts'
+
+# column weights for bm25(), in table order: title, author, genre, owner_id
+BM25_WEIGHTS = (10.0, 5.0, 2.0, 0.0)
+
+# the owner is part of the MATCH (see build_match_query), so only the
+# caller's books are ever scored
+SEARCH_SQL = text(
+    "SELECT book.* FROM book_fts "
+    "JOIN book ON book.id = book_fts.rowid "
+    "WHERE book_fts MATCH :match "
+    "ORDER BY bm25(book_fts, %s, %s, %s, %s) "
+    "LIMIT :limit" % BM25_WEIGHTS
+)
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match_query(terms, owner_id):
+    """Turn free text into an FTS5 query that prefix-matches every word
+    in the title, author or genre of one owner's books.
+
+    Each word is quoted so user input can never be read as FTS5 syntax
+    (AND, NEAR, column filters, ...). Returns None when there is nothing
+    to search for.
+    """
+    tokens = _TOKEN.findall(terms or '')
+    if not tokens:
+        return None
+    words = ' '.join('"%s"*' % token for token in tokens)
+    return 'owner_id : "%d" AND {title author genre} : (%s)' % (owner_id, words)
+
+
+def rebuild_index(engine, batch_size=500, optimize=False):
+    """Re-index every book in id ranges of `batch_size`, one short
+    transaction per range, so writers are only ever blocked for a batch.
+
+    Each range is deleted and re-inserted in the same transaction, which
+    keeps the rebuild idempotent and safe to run while the sync triggers
+    are live. Returns the number of rows indexed.
+    """
+    with engine.connect() as conn:
+        max_id = conn.execute(text("SELECT MAX(id) FROM book")).scalar() or 0
+
+    indexed = 0
+    low = 0
+    while low < max_id:
+        high = low + batch_size
+        with engine.begin() as conn:
+            conn.execute(
+                text("DELETE FROM book_fts WHERE rowid > :low AND rowid <= :high"),
+                {'low': low, 'high': high},
+            )
+            result = conn.execute(
+                text(
+                    "INSERT INTO book_fts (rowid, title, author, genre, owner_id) "
+                    "SELECT id, title, author, genre, owner_id FROM book "
+                    "WHERE id > :low AND id <= :high"
+                ),
+                {'low': low, 'high': high},
+            )
+            indexed += result.rowcount
+        low = high
+
+    if optimize:
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO book_fts (book_fts) VALUES ('optimize')"))
+
+    return indexed
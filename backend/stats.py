@@ -0,0 +1,110 @@
+"""
+Reading statistics kept in summary tables.
+
+The shelf_*_stats tables are maintained by triggers on `book` (see the
+shelf_stats migration), so they change in the same transaction as the book
+rows. This module reads them and can recompute them from scratch to detect
+and repair drift.
+"""
+
+from sqlalchemy import text
+
+
+class Aggregate:
+    def __init__(self, table, key, expression, sums=None):
+        self.table = table
+        self.key = key
+        self.expression = expression
+        # summed column -> book column
+        self.sums = sums or {}
+
+    @property
+    def value_columns(self):
+        return ['book_count'] + list(self.sums)
+
+    def recompute_sql(self):
+        sums = ''.join(', SUM(%s)' % column for column in self.sums.values())
+        return (
+            "SELECT owner_id, %s, COUNT(*)%s FROM book GROUP BY owner_id, %s"
+            % (self.expression, sums, self.expression)
+        )
+
+    def select_sql(self):
+        return "SELECT owner_id, %s, %s FROM %s" % (self.key, ', '.join(self.value_columns), self.table)
+
+
+# must match the expressions used by the triggers
+AGGREGATES = (
+    Aggregate('shelf_rating_stats', 'rating', 'CAST(rating AS INTEGER)'),
+    Aggregate('shelf_genre_stats', 'genre', "COALESCE(genre, '')", sums={'rating_sum': 'rating'}),
+    Aggregate('shelf_month_stats', 'month', "COALESCE(strftime('%Y-%m', date_created), '')"),
+    Aggregate('shelf_author_stats', 'author', 'author'),
+)
+
+TOP_AUTHORS = 10
+
+
+def user_stats(conn, owner_id):
+    params = {'owner_id': owner_id}
+    ratings = conn.execute(text(
+        "SELECT rating, book_count FROM shelf_rating_stats "
+        "WHERE owner_id = :owner_id ORDER BY rating"), params)
+    genres = conn.execute(text(
+        "SELECT genre, book_count, rating_sum FROM shelf_genre_stats "
+        "WHERE owner_id = :owner_id ORDER BY book_count DESC, genre"), params)
+    months = conn.execute(text(
+        "SELECT month, book_count FROM shelf_month_stats "
+        "WHERE owner_id = :owner_id ORDER BY month"), params)
+    authors = conn.execute(text(
+        "SELECT author, book_count FROM shelf_author_stats "
+        "WHERE owner_id = :owner_id ORDER BY book_count DESC, author LIMIT :limit"),
+        dict(params, limit=TOP_AUTHORS))
+
+    return {
+        'rating_histogram': {str(rating): count for rating, count in ratings},
+        'genres': [
+            {'genre': genre, 'books': count, 'average_rating': round(total / count, 2)}
+            for genre, count, total in genres
+        ],
+        'books_per_month': [{'month': month, 'books': count} for month, count in months],
+        'top_authors': [{'author': author, 'books': count} for author, count in authors],
+    }
+
+
+def _values_differ(expected, actual):
+    return any(abs((e or 0) - (a or 0)) > 1e-6 for e, a in zip(expected, actual))
+
+
+def reconcile(engine, fix=False):
+    """Compare every summary table with a full recomputation from `book`.
+
+    Returns a list of (table, (owner_id, key), expected, actual) tuples, one
+    per drifted row; missing rows show up as None. With fix=True each
+    drifted table is rebuilt in its own transaction.
+    """
+    drift = []
+    for aggregate in AGGREGATES:
+        with engine.begin() as conn:
+            expected = {
+                tuple(row[:2]): tuple(row[2:])
+                for row in conn.execute(text(aggregate.recompute_sql()))
+            }
+            actual = {
+                tuple(row[:2]): tuple(row[2:])
+                for row in conn.execute(text(aggregate.select_sql()))
+            }
+
+            table_drift = []
+            for key in expected.keys() | actual.keys():
+                want, have = expected.get(key), actual.get(key)
+                if want is None or have is None or _values_differ(want, have):
+                    table_drift.append((aggregate.table, key, want, have))
+            drift.extend(sorted(table_drift, key=lambda item: tuple(map(str, item[1]))))
+
+            if fix and table_drift:
+                conn.execute(text("DELETE FROM %s" % aggregate.table))
+                conn.execute(text(
+                    "INSERT INTO %s (owner_id, %s, %s) %s"
+                    % (aggregate.table, aggregate.key, ', '.join(aggregate.value_columns),
+                       aggregate.recompute_sql())))
+    return drift